@@ -0,0 +1,246 @@
+import functools, math, os, threading, time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, List, Optional
+
+from flask import jsonify, request
+
+# ------------------------------------------------------------------
+# Admission control for the analysis endpoints
+# ------------------------------------------------------------------
+# /upload and /practice/upload share one pool of ADMISSION_CONCURRENCY
+# slots.  A request that finds every slot busy waits in a short queue
+# (ADMISSION_QUEUE entries, at most ADMISSION_MAX_WAIT seconds).  When the
+# queue is full, or the wait runs out, it gets an immediate 503 with a
+# Retry-After estimate instead of piling up inside gunicorn, so quiz and
+# history pages keep their threads and admitted uploads keep a flat
+# latency.
+#
+# Fairness: waiters are grouped by client (patient_id for /upload, the
+# browser session for /practice/upload, else the client address) and a
+# freed slot goes to the next client in round-robin order,
+# not to the oldest request.  One client may hold at most
+# ADMISSION_PER_CLIENT slots + queue entries, so a single phone retrying
+# in a loop cannot take the whole queue.  X-Forwarded-For is only used
+# behind ADMISSION_PROXY_HOPS trusted proxies (the address they appended),
+# so a client cannot choose its own key.
+#
+# Counters are exported in Prometheus text format by /metrics.
+#
+# Limits are per process: with gunicorn --worker-class gthread and one
+# worker, the pool covers the whole container.
+#
+# Bulk exports (/export) hold a worker thread for the whole download, so
+# they get their own small pool without a queue.
+#
+# Queued requests block a gunicorn thread too, so every pool is sized out
+# of the thread count: exports + analysis slots + analysis queue never
+# exceed ADMISSION_THREADS - ADMISSION_RESERVE, and the reserved threads
+# always serve quiz / history / /metrics.  Larger explicit values are
+# clamped to that budget.  The default concurrency leaves at least
+# MIN_QUEUE of the budget for the short wait queue, also on many-core hosts.
+#
+# Envs:
+#   ADMISSION_THREADS      gunicorn --threads of the worker (default 8, as in the Dockerfile)
+#   ADMISSION_RESERVE      threads kept for non-analysis requests (default 2)
+#   ADMISSION_EXPORTS      concurrent bulk exports (default 1)
+#   ADMISSION_CONCURRENCY  analysis slots (default CPU count, at least 2, within the budget
+#                          minus MIN_QUEUE)
+#   ADMISSION_QUEUE        waiting requests (default the rest of the budget)
+#   ADMISSION_MAX_WAIT     seconds a request may wait (default 3)
+#   ADMISSION_PER_CLIENT   slots + queue entries per client (default 2; 0 = off)
+#   ADMISSION_PROXY_HOPS   reverse proxies in front of gunicorn whose X-Forwarded-For
+#                          is trusted (default 0 = use the peer address; Render: 1)
+# ------------------------------------------------------------------
+
+THREADS = int(os.environ.get("ADMISSION_THREADS", "8"))
+RESERVE = int(os.environ.get("ADMISSION_RESERVE", "2"))
+EXPORTS = max(1, int(os.environ.get("ADMISSION_EXPORTS", "1")))
+MIN_QUEUE = 2
+_BUDGET = max(1, THREADS - RESERVE - EXPORTS)  # threads analysis may block (slots + queue)
+_DEFAULT_CONCURRENCY = max(1, min(max(2, os.cpu_count() or 1), _BUDGET - MIN_QUEUE))
+CONCURRENCY = max(1, min(_BUDGET, int(os.environ.get("ADMISSION_CONCURRENCY", str(_DEFAULT_CONCURRENCY)))))
+QUEUE = max(0, min(_BUDGET - CONCURRENCY, int(os.environ.get("ADMISSION_QUEUE", str(_BUDGET)))))
+MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "3"))
+PER_CLIENT = int(os.environ.get("ADMISSION_PER_CLIENT", "2"))
+PROXY_HOPS = max(0, int(os.environ.get("ADMISSION_PROXY_HOPS", "0")))
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("client", "event", "granted", "since")
+
+    def __init__(self, client: str):
+        self.client = client
+        self.event = threading.Event()
+        self.granted = False
+        self.since = time.time()
+
+
+class AdmissionController:
+    def __init__(self, name: str, concurrency: int = CONCURRENCY, queue_size: int = QUEUE,
+                 max_wait: float = MAX_WAIT, per_client: int = PER_CLIENT):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.queue_size = max(0, queue_size)
+        self.max_wait = max_wait
+        self.per_client = per_client
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._queued = 0
+        self._waiting: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._held: Dict[str, int] = {}  # in-flight + queued per client
+        self._service_avg = 1.0  # seconds, EWMA
+        self._wait_avg = 0.0
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {"queue_full": 0, "client_limit": 0, "timeout": 0}
+
+    # ---- core ----
+
+    def _retry_after_locked(self) -> int:
+        backlog = self._queued + self._in_flight
+        return max(1, math.ceil(self._service_avg * backlog / self.concurrency))
+
+    def _reject_locked(self, reason: str) -> Rejected:
+        self.rejected[reason] += 1
+        return Rejected(reason, self._retry_after_locked())
+
+    def acquire(self, client: str):
+        """Take a slot for client, waiting up to max_wait; raises Rejected."""
+        with self._lock:
+            if self.per_client and self._held.get(client, 0) >= self.per_client:
+                raise self._reject_locked("client_limit")
+            if self._in_flight < self.concurrency and not self._queued:
+                self._in_flight += 1
+                self._held[client] = self._held.get(client, 0) + 1
+                self.admitted += 1
+                return
+            if self._queued >= self.queue_size:
+                raise self._reject_locked("queue_full")
+            waiter = _Waiter(client)
+            self._waiting.setdefault(client, deque()).append(waiter)
+            self._queued += 1
+            self._held[client] = self._held.get(client, 0) + 1
+
+        waiter.event.wait(self.max_wait)
+
+        with self._lock:
+            if waiter.granted:  # may have been granted right after the wait timed out
+                self._wait_avg += 0.2 * ((time.time() - waiter.since) - self._wait_avg)
+                return
+            queue = self._waiting.get(client)
+            if queue is not None:
+                queue.remove(waiter)
+                if not queue:
+                    del self._waiting[client]
+            self._queued -= 1
+            self._drop_held_locked(client)
+            raise self._reject_locked("timeout")
+
+    def release(self, client: str, service_seconds: float = None):
+        with self._lock:
+            self._in_flight -= 1
+            self._drop_held_locked(client)
+            if service_seconds is not None:
+                self._service_avg += 0.2 * (service_seconds - self._service_avg)
+            # hand freed slots to waiting clients in round-robin order
+            while self._in_flight < self.concurrency and self._waiting:
+                next_client, queue = next(iter(self._waiting.items()))
+                waiter = queue.popleft()
+                if queue:
+                    self._waiting.move_to_end(next_client)
+                else:
+                    del self._waiting[next_client]
+                self._queued -= 1
+                self._in_flight += 1
+                self.admitted += 1
+                waiter.granted = True
+                waiter.event.set()
+
+    def _drop_held_locked(self, client: str):
+        n = self._held.get(client, 0) - 1
+        if n > 0:
+            self._held[client] = n
+        else:
+            self._held.pop(client, None)
+
+    # ---- Flask ----
+
+    def guard(self, client_of: Callable[[], Optional[str]]):
+        """Decorator: run the view inside a slot, or answer 503 + Retry-After."""
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                client = client_of() or "anonymous"
+                try:
+                    self.acquire(client)
+                except Rejected as e:
+                    resp = jsonify({"error": "伺服器忙碌中，請稍後再試",
+                                    "reason": e.reason, "retry_after": e.retry_after})
+                    resp.status_code = 503
+                    resp.headers["Retry-After"] = str(e.retry_after)
+                    return resp
+                t0 = time.time()
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    self.release(client, time.time() - t0)
+            return wrapper
+        return decorator
+
+    # ---- metrics ----
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "queued": self._queued,
+                "concurrency": self.concurrency,
+                "queue_size": self.queue_size,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "service_seconds_avg": round(self._service_avg, 4),
+                "wait_seconds_avg": round(self._wait_avg, 4),
+            }
+
+
+def client_address() -> str:
+    """Client address as seen by the outermost of PROXY_HOPS trusted proxies, else the peer address.
+
+    Each proxy appends the address it received the request from, so only
+    the last PROXY_HOPS entries of X-Forwarded-For are trustworthy; the
+    entries before them are whatever the client sent.
+    """
+    if PROXY_HOPS:
+        hops = [h.strip() for h in request.headers.get("X-Forwarded-For", "").split(",") if h.strip()]
+        if len(hops) >= PROXY_HOPS:
+            return hops[-PROXY_HOPS]
+    return request.remote_addr or ""
+
+
+analysis = AdmissionController("analysis")
+export = AdmissionController("export", concurrency=EXPORTS, queue_size=0, per_client=0)
+controllers: List[AdmissionController] = [analysis, export]
+
+
+def render_metrics() -> str:
+    """Prometheus text exposition of every controller."""
+    lines = []
+    gauges = (("in_flight", "requests holding a slot"), ("queued", "requests waiting for a slot"),
+              ("concurrency", "slot limit"), ("queue_size", "queue limit"),
+              ("service_seconds_avg", "EWMA of slot hold time"), ("wait_seconds_avg", "EWMA of queue wait"))
+    snaps = [(c.name, c.snapshot()) for c in controllers]
+    for key, help_text in gauges:
+        lines += [f"# HELP admission_{key} {help_text}", f"# TYPE admission_{key} gauge"]
+        lines += [f'admission_{key}{{pool="{name}"}} {s[key]}' for name, s in snaps]
+    lines += ["# HELP admission_admitted_total admitted requests", "# TYPE admission_admitted_total counter"]
+    lines += [f'admission_admitted_total{{pool="{name}"}} {s["admitted"]}' for name, s in snaps]
+    lines += ["# HELP admission_rejected_total rejected requests", "# TYPE admission_rejected_total counter"]
+    for name, s in snaps:
+        lines += [f'admission_rejected_total{{pool="{name}",reason="{r}"}} {n}' for r, n in s["rejected"].items()]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,341 @@
+import os, resource, struct, threading, time, tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from color_analysis import _main_color_from_avg, _region_entry as _grid_entry
+from color_analysis_overlay import COLOR_TO_REGION, _load_overlay, _region_entry as _overlay_entry
+
+# ------------------------------------------------------------------
+# Memory-budgeted analysis
+# ------------------------------------------------------------------
+# The plain analyzers hold the decoded photo, a full-size resized
+# overlay, full LAB copies, one mask plus int64 np.where index arrays per
+# region at the same time -- tens of MB per 12 MP photo, per request.
+#
+# With ANALYSIS_MEMORY_BUDGET_MB set, uploads go through this module:
+#   * decode_within_budget() reads the image size from the JPEG / PNG /
+#     WebP header and lets libjpeg decode at 1/2, 1/4 or 1/8 scale, so the
+#     decoded photo never exceeds half the budget (and is never smaller
+#     than the analysis resolution when the budget allows it).  Only JPEG
+#     can be decoded reduced; any image whose decode would still exceed
+#     half the budget, or whose size cannot be read, raises OverBudget
+#     instead of being decoded whole;
+#   * the analyzers walk the image in row stripes sized from the other
+#     half of the budget, converting each stripe into a reused per-thread
+#     LAB buffer and accumulating per-region sums / sums of squares /
+#     counts with cv2.meanStdDev on a label mask -- no full-image
+#     temporaries at all;
+#   * the overlay is reduced once to a small label map (region index per
+#     overlay pixel) and sampled nearest-neighbour per stripe.
+#
+# MemoryMeter records per-stage peaks: the tracemalloc peak (numpy and
+# cv2 arrays are allocated through numpy, so they are traced) when
+# ANALYSIS_MEMORY_TRACE=1, and the process ru_maxrss otherwise.
+# tracemalloc is process-wide, so under concurrent requests its peaks
+# include the other requests' allocations.
+#
+# Envs:
+#   ANALYSIS_MEMORY_BUDGET_MB  per-job budget; 0 (default) = plain analyzers
+#   ANALYSIS_MEMORY_TRACE      1 = trace numpy allocations per stage
+# ------------------------------------------------------------------
+
+BUDGET_MB = float(os.environ.get("ANALYSIS_MEMORY_BUDGET_MB", "0"))
+BUDGET_BYTES = int(BUDGET_MB * 1024 * 1024)
+TRACE = os.environ.get("ANALYSIS_MEMORY_TRACE", "0") == "1"
+
+# working set per pixel of a stripe: LAB (3) + labels (1) + mask (1)
+# + the fancy-indexing temporary for the labels (1)
+STRIPE_BYTES_PER_PIXEL = 6
+MIN_STRIPE_ROWS = 8
+
+if TRACE and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+
+class OverBudget(ValueError):
+    """The image cannot be decoded within the memory budget."""
+
+
+# ---- memory accounting ----
+
+def _maxrss_kb() -> int:
+    # ru_maxrss is KiB on Linux (bytes on macOS)
+    return int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+class MemoryMeter:
+    """Per-stage peak memory of one analysis job."""
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            base, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            info = {"ms": round((time.perf_counter() - t0) * 1000.0, 1), "maxrss_kb": _maxrss_kb()}
+            if tracing:
+                _, peak = tracemalloc.get_traced_memory()
+                info["peak_kb"] = round(max(0, peak - base) / 1024.0, 1)
+            self.stages[name] = info
+
+    def peak_kb(self) -> Optional[float]:
+        peaks = [s["peak_kb"] for s in self.stages.values() if "peak_kb" in s]
+        return max(peaks) if peaks else None
+
+    def summary(self) -> str:
+        return ", ".join(
+            f"{name} {s.get('peak_kb', '-')}KB/{s['ms']}ms" for name, s in self.stages.items()
+        ) + f" (maxrss {_maxrss_kb()}KB)"
+
+
+# ---- budgeted decode ----
+
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """(width, height) from a JPEG, PNG or WebP header without decoding, or None."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b"VP8 " and data[23:26] == b"\x9d\x01\x2a":
+            w, h = struct.unpack("<HH", data[26:30])
+            return w & 0x3FFF, h & 0x3FFF
+        if chunk == b"VP8L" and data[20] == 0x2F:
+            bits = struct.unpack("<I", data[21:25])[0]
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            return (int.from_bytes(data[24:27], "little") + 1,
+                    int.from_bytes(data[27:30], "little") + 1)
+        return None
+    if data[:2] != b"\xff\xd8":
+        return None
+    i, n = 2, len(data)
+    while i + 9 < n:
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker == 0xFF or 0xD0 <= marker <= 0xD9 or marker == 0x01:
+            i += 2  # fill byte / standalone marker
+            continue
+        seg_len = struct.unpack(">H", data[i + 2:i + 4])[0]
+        if marker in _JPEG_SOF:
+            h, w = struct.unpack(">HH", data[i + 5:i + 9])
+            return w, h
+        i += 2 + seg_len
+    return None
+
+
+_REDUCED = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def _reduce_factor(w: int, h: int, max_side: int, budget_bytes: int) -> int:
+    factor = 1
+    # largest scale that still yields at least max_side on the long side
+    while max_side and factor < 8 and max(w, h) // (factor * 2) >= max_side:
+        factor *= 2
+    # then shrink further until the decoded photo fits half the budget
+    while budget_bytes and factor < 8 and (w // factor) * (h // factor) * 3 > budget_bytes // 2:
+        factor *= 2
+    return factor
+
+
+def decode_within_budget(data: bytes, max_side: int = 0,
+                         budget_bytes: int = None) -> Tuple[Optional[np.ndarray], Optional[Tuple[int, int]]]:
+    """Decode at the smallest libjpeg scale that still covers max_side.
+
+    Returns (BGR image, original (width, height)); the image still needs
+    fit_max_side().  With a budget, raises OverBudget when the size cannot
+    be read or the decoded image would not fit half the budget (PNG / WebP
+    always decode at full size; JPEG at most 1/8).
+    """
+    if not data:
+        return None, None
+    budget_bytes = BUDGET_BYTES if budget_bytes is None else budget_bytes
+    size = image_size(data)
+    # only libjpeg decodes at a reduced scale; for other formats the reduced
+    # modes decode at full size and resize afterwards
+    reducible = size is not None and data[:2] == b"\xff\xd8"
+    factor = _reduce_factor(size[0], size[1], max_side, budget_bytes) if reducible else 1
+    if budget_bytes:
+        if size is None:
+            raise OverBudget("無法讀取影像尺寸")
+        if (size[0] // factor) * (size[1] // factor) * 3 > budget_bytes // 2:
+            raise OverBudget("影像解析度過大")
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), _REDUCED.get(factor, cv2.IMREAD_COLOR))
+    if img is None:
+        return None, None
+    return img, size or (img.shape[1], img.shape[0])
+
+
+# ---- striped accumulation ----
+
+class _Buffers(threading.local):
+    """Per-thread stripe buffers, grown on demand and reused across jobs."""
+
+    def __init__(self):
+        self.lab = self.labels = self.mask = None
+
+    def get(self, rows: int, width: int):
+        if self.lab is None or self.lab.shape[0] < rows or self.lab.shape[1] != width:
+            self.lab = np.empty((rows, width, 3), np.uint8)
+            self.labels = np.empty((rows, width), np.uint8)
+            self.mask = np.empty((rows, width), np.uint8)
+        return self.lab, self.labels, self.mask
+
+
+_buffers = _Buffers()
+
+
+def stripe_rows(width: int, budget_bytes: int = None) -> int:
+    """Rows per stripe so the stripe working set fits half the budget."""
+    budget_bytes = BUDGET_BYTES if budget_bytes is None else budget_bytes
+    if not budget_bytes:
+        return 256
+    return max(MIN_STRIPE_ROWS, (budget_bytes // 2) // max(1, width * STRIPE_BYTES_PER_PIXEL))
+
+
+def _striped_sums(img: np.ndarray, n_labels: int, fill_labels: Callable[[int, int, np.ndarray], None],
+                  rows: int):
+    """LAB sums / sums of squares / pixel counts, one stripe at a time.
+
+    Row 0 covers the whole image, row k the pixels labelled k (1..n_labels).
+    """
+    h, w = img.shape[:2]
+    lab_buf, label_buf, mask_buf = _buffers.get(min(rows, h), w)
+    sums = np.zeros((n_labels + 1, 3))
+    sumsq = np.zeros((n_labels + 1, 3))
+    counts = np.zeros(n_labels + 1, np.int64)
+
+    def add(k, lab, mask, cnt):
+        mean, std = cv2.meanStdDev(lab, mask=mask)
+        mean, std = mean.ravel(), std.ravel()
+        sums[k] += mean * cnt
+        sumsq[k] += (std * std + mean * mean) * cnt
+        counts[k] += cnt
+
+    for y0 in range(0, h, rows):
+        y1 = min(h, y0 + rows)
+        lab = lab_buf[:y1 - y0]
+        labels = label_buf[:y1 - y0]
+        mask = mask_buf[:y1 - y0]
+        cv2.cvtColor(img[y0:y1], cv2.COLOR_BGR2LAB, dst=lab)
+        add(0, lab, None, (y1 - y0) * w)
+        fill_labels(y0, y1, labels)
+        for k in range(1, n_labels + 1):
+            cv2.compare(labels, k, cv2.CMP_EQ, dst=mask)
+            cnt = cv2.countNonZero(mask)
+            if cnt:
+                add(k, lab, mask, cnt)
+    return sums, sumsq, counts
+
+
+def _stats(names: List[str], sums, sumsq, counts) -> Dict[str, Tuple[np.ndarray, np.ndarray, int]]:
+    """{"整體" / 區域: (mean[3], std[3], pixels)} like analyze_tongue_regions_with_overlay_stats."""
+    out = {}
+    for k, name in enumerate(["整體"] + list(names)):
+        if counts[k]:
+            mean = sums[k] / counts[k]
+            std = np.sqrt(np.maximum(0.0, sumsq[k] / counts[k] - mean * mean))
+            out[name] = (mean, std, int(counts[k]))
+    return out
+
+
+_label_cache: Dict[str, Tuple[np.ndarray, List[str]]] = {}
+
+
+def overlay_labels(overlay_path: str) -> Tuple[Optional[np.ndarray], List[str]]:
+    """Overlay reduced to a uint8 map: 0 = none, i = i-th region in COLOR_TO_REGION."""
+    cached = _label_cache.get(overlay_path)
+    if cached is None:
+        overlay = _load_overlay(overlay_path)
+        if overlay is None:
+            return None, []
+        labels = np.zeros(overlay.shape[:2], np.uint8)
+        names = []
+        for bgr_color, region in COLOR_TO_REGION.items():
+            names.append(region)
+            labels[cv2.inRange(overlay, np.array(bgr_color), np.array(bgr_color)) == 255] = len(names)
+        cached = _label_cache[overlay_path] = (labels, names)
+    return cached
+
+
+def _overlay_sums(img, overlay_path, rows):
+    labels_small, names = overlay_labels(overlay_path)
+    if labels_small is None:
+        raise FileNotFoundError("圖像或 overlay 讀取失敗")
+    h, w = img.shape[:2]
+    oh, ow = labels_small.shape
+    # nearest-neighbour source row / column of every output pixel
+    cols = (np.arange(w) * ow) // w
+
+    def fill(y0, y1, out):
+        src_rows = (np.arange(y0, y1) * oh) // h
+        out[...] = labels_small[src_rows[:, None], cols]
+
+    return names, _striped_sums(img, len(names), fill, rows)
+
+
+_GRID = (("肺", "心", None), ("肝", None, "脾"), (None, "腎", None))
+_GRID_NAMES = ["心", "肝", "脾", "肺", "腎"]
+
+
+def _grid_sums(img, rows):
+    h, w = img.shape[:2]
+    table = np.zeros((3, 3), np.uint8)
+    for r, row in enumerate(_GRID):
+        for c, name in enumerate(row):
+            if name:
+                table[r, c] = _GRID_NAMES.index(name) + 1
+    # same thirds as color_analysis._region_results (h//3, 2*h//3, ...)
+    col_band = np.searchsorted([w // 3, 2 * w // 3], np.arange(w), side="right")
+
+    def fill(y0, y1, out):
+        row_band = np.searchsorted([h // 3, 2 * h // 3], np.arange(y0, y1), side="right")
+        out[...] = table[row_band[:, None], col_band]
+
+    return _GRID_NAMES, _striped_sums(img, len(_GRID_NAMES), fill, rows)
+
+
+# ---- public analyzers ----
+
+def analyze_overlay_striped(img: np.ndarray, overlay_path: str = "static/TongueOverlay.png",
+                            budget_bytes: int = None, meter: MemoryMeter = None):
+    """Budgeted main colour + overlay regions.
+
+    Returns ((main_color, comment, advice, avg_lab), regions, stats) in the
+    same shapes as analyze_image_color_array /
+    analyze_tongue_regions_with_overlay_stats.  Region borders are sampled
+    nearest-neighbour, so a few boundary pixels may differ from the
+    full-size bilinear overlay.
+    """
+    meter = meter or MemoryMeter()
+    with meter.stage("regions"):
+        names, sums = _overlay_sums(img, overlay_path, stripe_rows(img.shape[1], budget_bytes))
+        stats = _stats(names, *sums)
+        regions = [_overlay_entry(name, stats[name][0]) for name in names if name in stats]
+    return _main_color_from_avg(stats["整體"][0]), regions, stats
+
+
+def analyze_grid_striped(img: np.ndarray, budget_bytes: int = None, meter: MemoryMeter = None):
+    """Budgeted equivalent of color_analysis.analyze_image_array."""
+    meter = meter or MemoryMeter()
+    with meter.stage("regions"):
+        names, sums = _grid_sums(img, stripe_rows(img.shape[1], budget_bytes))
+        stats = _stats(names, *sums)
+        regions = {name: _grid_entry(name, stats[name][0] if name in stats else np.zeros(3))
+                   for name in names}
+    main_color, comment, advice, avg = _main_color_from_avg(stats["整體"][0])
+    return main_color, comment, advice, avg, regions
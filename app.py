@@ -1,19 +1,31 @@
 # app.py —— 主專案（Blueprint 版本，修正 PyMongo bool 判斷）
-from flask import Flask, render_template, request, jsonify, session
-import os, json, datetime, tempfile, io, base64
+from flask import Flask, render_template, request, jsonify, session, make_response, send_from_directory
+import os, json, datetime, io, base64, uuid
+from urllib.parse import quote
 from dotenv import load_dotenv
 from pymongo import MongoClient
 from bson import ObjectId
 
 import cloudinary
-import cloudinary.uploader
 from cloud_quiz_search import get_random_cloudinary_question
-import cloudinary.api
 from cloudinary.search import Search
 from tongue_quiz_data import quiz_data
 
-from color_analysis import analyze_image_color
-from color_analysis_overlay import analyze_tongue_regions_with_overlay
+import image_variants
+import image_storage
+from asset_purger import purger, asset_ids
+import history_trend
+from quiz_session import QuizSessionStore, QuizPrefetcher
+from color_analysis import analyze_image_color_array, decode_image_bytes, fit_max_side
+from color_analysis_overlay import analyze_tongue_regions_with_overlay_stats
+import analysis_budget
+import stream_analysis
+import quality_gate
+import similar_cases
+import admission
+import diagnosis_codes
+import color_calibration
+import record_export
 
 # =========================
 # 基本設定
@@ -29,6 +41,8 @@ MONGO_URI = os.environ.get("MONGO_URI")
 mongo_client = None
 mongo_db = None
 records_collection = None
+rollups_collection = None
+calibration_collection = None
 
 if MONGO_URI:
     try:
@@ -36,10 +50,16 @@ if MONGO_URI:
         mongo_client.admin.command("ping")  # 確認可連線
         mongo_db = mongo_client.get_database("tongueDB")
         records_collection = mongo_db.get_collection("records")
+        rollups_collection = mongo_db.get_collection("record_rollups")
+        calibration_collection = mongo_db.get_collection("calibration_profiles")
+        history_trend.ensure_indexes(rollups_collection)
+        record_export.ensure_indexes(records_collection)
     except Exception:
         mongo_client = None
         mongo_db = None
         records_collection = None
+        rollups_collection = None
+        calibration_collection = None
 
 # ---- Cloudinary ----
 cloudinary.config(
@@ -48,11 +68,30 @@ cloudinary.config(
     api_secret=os.environ.get("CLOUD_API_SECRET")
 )
 
+# ---- 拍照 / 分析解析度（前端拍照時依此縮圖，與後端分析一致）----
+ANALYSIS_MAX_SIDE = int(os.environ.get("ANALYSIS_MAX_SIDE", "1280"))
+CAPTURE_QUALITY = float(os.environ.get("CAPTURE_QUALITY", "0.85"))
+CAPTURE_MIME = os.environ.get("CAPTURE_MIME", "image/jpeg")  # 或 image/webp
+
+# ---- 圖片儲存後端（IMAGE_STORAGE=cloudinary | local）----
+storage = image_storage.get_storage()
+
+if isinstance(storage, image_storage.LocalStorage):
+    @app.get(f"{storage.url_prefix}/<path:public_id>")
+    def local_media(public_id):
+        # send_from_directory 走 wsgi.file_wrapper，gunicorn 會以 sendfile 傳送
+        return send_from_directory(storage.root, public_id, max_age=31536000)
+
 # 健康檢查（Render/監控用）
 @app.get("/healthz")
 def healthz():
     return "ok", 200
 
+# 分析端點的併發 / 佇列 / 拒絕次數（Prometheus 文字格式）
+@app.get("/metrics")
+def metrics():
+    return admission.render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
 # =========================
 # 一般頁面
 # =========================
@@ -70,10 +109,29 @@ def index():
     patient_id = request.args.get("patient", "unknown")
     return render_template("index.html", patient_id=patient_id)
 
+@app.get("/capture_config")
+def capture_config():
+    """前端拍照參數：最長邊、壓縮品質、格式（不支援時退回 JPEG）、連拍張數。"""
+    return jsonify({
+        "max_side": ANALYSIS_MAX_SIDE,
+        "quality": CAPTURE_QUALITY,
+        "mime": CAPTURE_MIME,
+        "fallback_mime": "image/jpeg",
+        "burst": quality_gate.BURST,
+    })
+
 # =========================
 # 上傳、分析、儲存（主流程）
 # =========================
+def _upload_client():
+    """公平排隊用的使用者識別：網址上的病患 ID，否則用來源位址。
+
+    不讀 request.form：取得名額前就解析 multipart 會先把整張圖讀進來。
+    """
+    return (request.args.get("patient") or "").strip() or admission.client_address()
+
 @app.route("/upload", methods=["POST"])
+@admission.analysis.guard(_upload_client)
 def upload_image():
     # 允許 multipart file 或 base64 data（image 欄位）
     if 'image' not in request.files and 'image' not in request.form:
@@ -82,47 +140,91 @@ def upload_image():
     patient_id = (request.form.get('patient_id') or 'unknown').strip()
     if not patient_id:
         return "Missing patient ID", 400
+    device_id = (request.form.get('device_id') or '').strip()
+    if device_id and not color_calibration.valid_device_id(device_id):
+        return "Invalid device ID", 400
 
-    # 讀入位元資料
-    image_bytes = None
-    fileobj = request.files.get('image')
-    if fileobj is not None:
-        image_bytes = fileobj.read()
-    else:
+    # 讀入位元資料（連拍時同一欄位會有多張）
+    payloads = [f.read() for f in request.files.getlist('image')]
+    if not payloads:
         raw = request.form.get('image', '')
         try:
             if raw.startswith('data:'):
                 # data URL
                 _, b64 = raw.split(',', 1)
-                image_bytes = base64.b64decode(b64)
+                payloads = [base64.b64decode(b64)]
             else:
                 # 純 base64
-                image_bytes = base64.b64decode(raw)
+                payloads = [base64.b64decode(raw)]
         except Exception:
             return "Invalid image payload", 400
 
-    try:
-        image_stream = io.BytesIO(image_bytes)
-
-        # 上傳至 Cloudinary（依病患分資料夾）
-        up_res = cloudinary.uploader.upload(image_stream, folder=f"tongue/{patient_id}/")
-        image_url = up_res.get("secure_url")
-
-        # 暫存檔做分析
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-            tmp.write(image_bytes)
-            tmp.flush()
-            tmp_path = tmp.name
-
-        # 主色與五區分析（沿用你的 color_analysis* 模組）
-        main_color, comment, advice, rgb = analyze_image_color(tmp_path)
-        five_regions = analyze_tongue_regions_with_overlay(tmp_path)
-
-        # 刪暫存
+    # 記憶體內解碼一次，縮到與前端相同的分析解析度
+    # （設定 ANALYSIS_MEMORY_BUDGET_MB 時以縮小比例解碼，記憶體有上限）
+    # 連拍時逐張解碼並評估品質，只保留最好的一張
+    meter = analysis_budget.MemoryMeter()
+    img = original_width = quality = image_bytes = over_budget = None
+    for data in payloads:
         try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+            with meter.stage("decode"):
+                candidate, candidate_width = _decode_for_analysis(data)
+        except analysis_budget.OverBudget as e:
+            over_budget = e
+            continue
+        if candidate is None:
+            continue
+        with meter.stage("quality"):
+            report = quality_gate.assess(candidate)
+        if quality is None or quality_gate.is_better(report, quality):
+            img, original_width, quality, image_bytes = candidate, candidate_width, report, data
+        del candidate
+    if img is None and over_budget is not None:
+        return jsonify({"error": "影像過大，無法分析", "detail": str(over_budget)}), 413
+    if img is None:
+        return "Invalid image payload", 400
+
+    # 品質把關：模糊 / 曝光不良 / 沒拍到舌頭就直接退回，不上傳、不分析、不寫庫
+    if quality_gate.ENABLED and not quality["ok"]:
+        return jsonify({
+            "error": "影像品質不足，請重拍",
+            "reasons": quality["reasons"],
+            "quality": quality,
+        }), 422
+
+    try:
+        # 存入圖片儲存後端（依病患分資料夾），同時預先產生縮圖 / 中圖
+        stored = storage.put(
+            image_bytes,
+            folder=f"tongue/{patient_id}/",
+            eager=image_variants.eager_transformations(),
+        )
+        image_url = stored["url"]
+        image_width = stored.get("width") or original_width
+        variants = stored.get("variants") or {}
+        variant_public_ids = []
+        if not variants:
+            # 後端無法衍生時改為本機縮圖後另存
+            variants, variant_public_ids = _store_local_variants(img, patient_id)
+
+        # 裝置色彩校正：原圖照常儲存，只校正分析用的影像（查表一次、原地完成）
+        calibration = None
+        profile = _calibration_store().lookup(device_id) if device_id else None
+        if profile is not None:
+            with meter.stage("calibrate"):
+                color_calibration.apply(img, profile[1])
+            calibration = {"device_id": device_id, "v": profile[0]}
+
+        # 主色與五區分析（沿用你的 color_analysis* 模組；有記憶體預算時分條累加）
+        if analysis_budget.BUDGET_BYTES:
+            (main_color, comment, advice, rgb), five_regions, region_stats = \
+                analysis_budget.analyze_overlay_striped(img, meter=meter)
+        else:
+            with meter.stage("regions"):
+                main_color, comment, advice, rgb = analyze_image_color_array(img)
+                five_regions, region_stats = analyze_tongue_regions_with_overlay_stats(img)
+        features = similar_cases.feature_vector(region_stats)
+        if analysis_budget.TRACE:
+            print(f"🧮 分析記憶體：{meter.summary()}")
 
         # 寫入 MongoDB（歷史紀錄）
         inserted_id = None
@@ -130,36 +232,180 @@ def upload_image():
             record = {
                 "patient_id": patient_id,
                 "image_url": image_url,
+                "public_id": stored.get("public_id"),
+                "image_width": image_width,
+                "image_variants": variants,
+                "variant_public_ids": variant_public_ids,
                 "main_color": main_color,
                 "comment": comment,
                 "advice": advice,
                 "rgb": rgb,
-                "five_regions": five_regions,
+                # 五區只存代碼 + 規則版本，文字由 /ruleset/<v> 提供、前端組合
+                **diagnosis_codes.compact_fields(five_regions),
+                "features": features,
+                "features_v": similar_cases.FEATURE_VERSION,
+                "calibration": calibration,
                 "timestamp": datetime.datetime.utcnow()
             }
             inserted_id = records_collection.insert_one(record).inserted_id
+            history_trend.apply_rollup(rollups_collection, record, records=records_collection)
+            _similar_index().add(inserted_id, patient_id, features)
 
         return jsonify({
             "success": True,
             "id": str(inserted_id) if inserted_id is not None else None,
             "image_url": image_url,
+            "image_variants": variants,
+            "srcset": image_variants.build_srcset(variants, image_url, image_width),
             "舌苔主色": main_color,
             "中醫推論": comment,
             "醫療建議": advice,
             "主色RGB": rgb,
-            "五區分析": five_regions
+            "五區分析": five_regions,
+            "quality": quality,
+            "calibration": calibration
         })
 
     except Exception as e:
         return jsonify({"error": "上傳失敗", "detail": str(e)}), 500
 
+def _decode_for_analysis(image_bytes):
+    """解碼並縮到分析解析度：回傳 (BGR 影像或 None, 原圖寬度)。"""
+    if analysis_budget.BUDGET_BYTES:
+        img, original_size = analysis_budget.decode_within_budget(image_bytes, ANALYSIS_MAX_SIDE)
+        original_width = original_size[0] if original_size else None
+    else:
+        img = decode_image_bytes(image_bytes)
+        original_width = img.shape[1] if img is not None else None
+    if img is None:
+        return None, None
+    return fit_max_side(img, ANALYSIS_MAX_SIDE), original_width
+
+def _store_local_variants(img, patient_id):
+    """本機縮圖備援：回傳 ({名稱: url}, [public_id, ...])。"""
+    variants, public_ids = {}, []
+    for name, (data, _) in image_variants.resize_variants(img).items():
+        try:
+            res = storage.put(data, folder=f"tongue/{patient_id}/variants/")
+        except Exception:
+            continue
+        variants[name] = res["url"]
+        public_ids.append(res["public_id"])
+    return variants, public_ids
+
+def _with_variants(doc):
+    """補上 image_variants / srcset（舊紀錄由 Cloudinary 網址推導）。"""
+    url = doc.get("image_url", "")
+    variants = doc.get("image_variants") or image_variants.variants_from_url(url)
+    doc["image_variants"] = variants
+    doc["srcset"] = image_variants.build_srcset(variants, url, doc.get("image_width"))
+    return doc
+
+# =========================
+# 即時串流分析（拍照前預覽各區讀數）
+# =========================
+@app.post("/stream/start")
+def stream_start():
+    """?device=<裝置ID>：有校正檔時即時讀數也套用同一張校正表。"""
+    device_id = (request.args.get("device") or "").strip()
+    if device_id and not color_calibration.valid_device_id(device_id):
+        return jsonify({"error": "Invalid device ID"}), 400
+    profile = _calibration_store().lookup(device_id) if device_id else None
+    try:
+        s = stream_analysis.registry.start(lut=profile[1] if profile else None)
+    except stream_analysis.TooManyStreams:
+        # 串流在 STREAM_IDLE_SECONDS 內沒有影格就會釋放
+        resp = jsonify({"error": "即時分析人數已滿，請稍後再試", "retry_after": int(stream_analysis.IDLE_SECONDS)})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = str(int(stream_analysis.IDLE_SECONDS))
+        return resp
+    return jsonify({
+        "stream_id": s.stream_id,
+        "max_side": stream_analysis.MAX_SIDE,
+        "next_ms": int(s.interval_ms),
+    })
+
+@app.post("/stream/<stream_id>/frame")
+def stream_frame(stream_id):
+    """低解析度影格（原始 JPEG/WebP 位元組）；忙碌時略過並回傳上一筆讀數。"""
+    s = stream_analysis.registry.get(stream_id)
+    if s is None:
+        return jsonify({"error": "串流不存在或已逾時"}), 404
+    if (request.content_length or 0) > stream_analysis.MAX_FRAME_BYTES:
+        return jsonify({"error": "影格過大"}), 413
+    data = request.get_data(cache=False)
+    if len(data) > stream_analysis.MAX_FRAME_BYTES:
+        return jsonify({"error": "影格過大"}), 413
+    try:
+        out = s.feed_bytes(data)
+    except stream_analysis.FrameRejected:
+        return jsonify({"error": "影格尺寸過大"}), 413
+    except Exception as e:
+        return jsonify({"error": "分析失敗", "detail": str(e)}), 500
+    if out is None:
+        return jsonify({"error": "影格無法解碼"}), 400
+    return jsonify(out)
+
+@app.post("/stream/<stream_id>/stop")
+def stream_stop(stream_id):
+    stream_analysis.registry.stop(stream_id)
+    return jsonify({"success": True})
+
+# =========================
+# 裝置色彩校正（拍一次白卡 / 灰卡，之後該裝置的上傳都套用校正表）
+# =========================
+_calibration = None
+
+def _calibration_store():
+    global _calibration
+    if _calibration is None or _calibration.collection is not calibration_collection:
+        _calibration = color_calibration.CalibrationStore(calibration_collection)
+    return _calibration
+
+def _profile_json(doc):
+    doc = {"device_id": doc["_id"], **{k: v for k, v in doc.items() if k != "_id"}}
+    if doc.get("updated_at"):
+        doc["updated_at"] = doc["updated_at"].strftime("%Y-%m-%d %H:%M:%S")
+    return doc
+
+@app.route("/calibration/<device_id>", methods=["GET", "POST", "DELETE"])
+def device_calibration(device_id):
+    """POST 白卡參考影像（multipart image）建立 / 更新校正；GET 查詢；DELETE 移除。"""
+    if not color_calibration.valid_device_id(device_id):
+        return jsonify({"error": "Invalid device ID"}), 400
+    if calibration_collection is None:
+        return jsonify({"error": "DB 未設定"}), 500
+    store = _calibration_store()
+
+    try:
+        if request.method == "GET":
+            doc = store.get(device_id)
+            if doc is None:
+                return jsonify({"error": "此裝置尚未校正"}), 404
+            return jsonify(_profile_json(doc))
+        if request.method == "DELETE":
+            return jsonify({"success": True, "deleted": store.delete(device_id)})
+
+        f = request.files.get("image")
+        img = decode_image_bytes(f.read() if f else request.get_data(cache=False))
+        if img is None:
+            return jsonify({"error": "影像無法解碼"}), 400
+        try:
+            profile = color_calibration.fit_profile(img)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 422
+        return jsonify(dict(_profile_json(store.save(device_id, profile)), success=True))
+    except Exception as e:
+        return jsonify({"error": "校正失敗", "detail": str(e)}), 500
+
 # =========================
 # 歷史紀錄
 # =========================
 @app.route("/history")
 def history():
     patient_id = request.args.get("patient", "unknown")
-    return render_template("history.html", patient_id=patient_id)
+    return render_template("history.html", patient_id=patient_id,
+                           ruleset_version=diagnosis_codes.RULESET_VERSION)
 
 @app.route("/history_data", methods=["GET"])
 def get_history_data():
@@ -168,14 +414,102 @@ def get_history_data():
         return jsonify([])
 
     try:
-        records = list(records_collection.find({"patient_id": patient_id}).sort("timestamp", -1))
+        records = list(records_collection.find({"patient_id": patient_id}, {"features": 0}).sort("timestamp", -1))
         for r in records:
             r["_id"] = str(r["_id"])
             r["timestamp"] = r["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
+            r.pop("variant_public_ids", None)
+            _with_variants(r)
         return jsonify(records)
     except Exception as e:
         return jsonify({"error": "查詢失敗", "detail": str(e)}), 500
 
+# 刪除時只需取回的欄位（圖片 + 趨勢統計回沖）
+_ASSET_FIELDS = {"public_id": 1, "image_url": 1, "variant_public_ids": 1,
+                 "patient_id": 1, "timestamp": 1, "rgb": 1, "five_regions": 1, "region_codes": 1}
+
+@app.route("/ruleset/<int:version>", methods=["GET"])
+def get_ruleset(version):
+    """五區代碼對照表（理論 / 建議文字）；同一版本內容不變，可長期快取。"""
+    table = diagnosis_codes.ruleset(version)
+    if table is None:
+        return jsonify({"error": "ruleset not found"}), 404
+    resp = jsonify(table)
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
+
+@app.route("/history_trend", methods=["GET"])
+def get_history_trend():
+    """舌色趨勢：?patient=...&unit=day|week|month[&start=YYYY-MM-DD&end=YYYY-MM-DD]"""
+    patient_id = (request.args.get("patient") or "").strip()
+    if not patient_id or records_collection is None:
+        return jsonify({"patient_id": patient_id, "points": []})
+
+    unit = request.args.get("unit", "week")
+    if unit not in history_trend.UNITS:
+        return jsonify({"error": "unit 需為 day / week / month"}), 400
+    try:
+        start = request.args.get("start")
+        end = request.args.get("end")
+        start = datetime.datetime.strptime(start, "%Y-%m-%d") if start else None
+        end = datetime.datetime.strptime(end, "%Y-%m-%d") if end else None
+    except ValueError:
+        return jsonify({"error": "日期格式需為 YYYY-MM-DD"}), 400
+
+    try:
+        return jsonify(history_trend.get_trend(records_collection, rollups_collection,
+                                               patient_id, unit, start, end))
+    except Exception as e:
+        return jsonify({"error": "查詢失敗", "detail": str(e)}), 500
+
+@app.route("/export", methods=["GET"])
+def export_records():
+    """串流匯出紀錄：?format=ndjson|csv|parquet[&patient=...][&start=YYYY-MM-DD&end=YYYY-MM-DD]
+
+    需帶 X-Export-Token 標頭（= EXPORT_TOKEN）；未設定 EXPORT_TOKEN 時不開放。
+    逐批讀取游標、邊讀邊送，記憶體用量與匯出大小無關。
+    """
+    if not record_export.TOKEN or request.headers.get("X-Export-Token") != record_export.TOKEN:
+        return jsonify({"error": "未授權"}), 403
+    if records_collection is None:
+        return jsonify({"error": "DB 未設定"}), 500
+
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in record_export.available_formats():
+        return jsonify({"error": "format 需為 " + " / ".join(record_export.available_formats())}), 400
+    try:
+        start = request.args.get("start")
+        end = request.args.get("end")
+        start = datetime.datetime.strptime(start, "%Y-%m-%d") if start else None
+        end = datetime.datetime.strptime(end, "%Y-%m-%d") if end else None
+    except ValueError:
+        return jsonify({"error": "日期格式需為 YYYY-MM-DD"}), 400
+    flt = record_export.export_filter((request.args.get("patient") or "").strip() or None, start, end)
+
+    # 匯出會佔住一條執行緒直到下載結束：另設名額，回應關閉時才釋放
+    client = admission.client_address()
+    try:
+        admission.export.acquire(client)
+    except admission.Rejected as e:
+        resp = jsonify({"error": "已有匯出進行中，請稍後再試", "retry_after": e.retry_after})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = str(e.retry_after)
+        return resp
+    t0 = datetime.datetime.utcnow()
+    try:
+        # 查詢與第一段編碼在這裡完成：資料庫錯誤回 500，而不是送出一半的檔案
+        body = record_export.export_chunks(records_collection, fmt, flt)
+    except Exception as e:
+        admission.export.release(client)
+        return jsonify({"error": "匯出失敗", "detail": str(e)}), 500
+
+    resp = app.response_class(body, content_type=record_export.FORMATS[fmt])
+    resp.headers["Content-Disposition"] = f"attachment; filename=records-{t0:%Y%m%d-%H%M%S}.{fmt}"
+    resp.headers["X-Accel-Buffering"] = "no"  # 反向代理不要整包緩衝
+    resp.call_on_close(lambda: admission.export.release(
+        client, (datetime.datetime.utcnow() - t0).total_seconds()))
+    return resp
+
 @app.route("/delete_record", methods=["POST"])
 def delete_record():
     if records_collection is None:
@@ -187,22 +521,114 @@ def delete_record():
         return jsonify({"error": "Missing ID"}), 400
 
     try:
-        record = records_collection.find_one({"_id": ObjectId(record_id)})
+        # 單一 DB 往返：刪除並取回圖片 public_id；雲端圖片交給背景批次刪除
+        record = records_collection.find_one_and_delete(
+            {"_id": ObjectId(record_id)}, projection=_ASSET_FIELDS
+        )
         if record is None:
             return jsonify({"error": "Record not found"}), 404
 
-        # 建議：上傳時把 public_id 一起存；此處以 URL 推 public_id（有子資料夾時可能不準）
-        public_id = record["image_url"].split("/")[-1].split(".")[0]
-        try:
-            cloudinary.uploader.destroy(public_id)
-        except Exception:
-            pass
-
-        records_collection.delete_one({"_id": ObjectId(record_id)})
+        purger.enqueue(asset_ids(record))
+        history_trend.apply_rollup(rollups_collection, record, sign=-1)
+        _similar_index().remove(record["_id"])
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": "刪除失敗", "detail": str(e)}), 500
 
+@app.route("/delete_patient_records", methods=["POST"])
+def delete_patient_records():
+    """刪除某位病患的全部歷史紀錄（雲端圖片同樣背景批次刪除）。"""
+    if records_collection is None:
+        return jsonify({"error": "DB 未設定"}), 500
+
+    data = request.get_json(silent=True) or {}
+    patient_id = (data.get("patient_id") or "").strip()
+    if not patient_id:
+        return jsonify({"error": "Missing patient ID"}), 400
+
+    try:
+        docs = list(records_collection.find({"patient_id": patient_id}, _ASSET_FIELDS))
+        if not docs:
+            return jsonify({"success": True, "deleted": 0})
+        res = records_collection.delete_many({"_id": {"$in": [d["_id"] for d in docs]}})
+        purger.enqueue(pid for d in docs for pid in asset_ids(d))
+        for d in docs:
+            _similar_index().remove(d["_id"])
+        if rollups_collection is not None:
+            rollups_collection.delete_many({"patient_id": patient_id})
+        return jsonify({"success": True, "deleted": res.deleted_count})
+    except Exception as e:
+        return jsonify({"error": "刪除失敗", "detail": str(e)}), 500
+
+# =========================
+# 相似病例（依各區 LAB 特徵向量找最接近的歷史紀錄）
+# =========================
+_similar = None
+
+def _similar_index():
+    """每個 worker 一份記憶體索引，第一次查詢時載入，之後增量更新。"""
+    global _similar
+    if _similar is None or _similar.collection is not records_collection:
+        _similar = similar_cases.SimilarIndex(records_collection)
+    return _similar
+
+@app.route("/similar_cases", methods=["GET"])
+def get_similar_cases():
+    """?id=<紀錄ID>&k=10&scope=all|others|same（全部 / 其他病患 / 同一病患）
+
+    其他病患的命中只含診斷、主色、日期與距離，不含可識別的欄位。
+    """
+    if records_collection is None:
+        return jsonify({"error": "DB 未設定"}), 500
+    record_id = (request.args.get("id") or "").strip()
+    scope = request.args.get("scope", "all")
+    try:
+        k = max(1, min(50, int(request.args.get("k", 10))))
+        source = records_collection.find_one({"_id": ObjectId(record_id)}, {"patient_id": 1, "features": 1})
+    except Exception:
+        return jsonify({"error": "Invalid ID"}), 400
+    if source is None:
+        return jsonify({"error": "Record not found"}), 404
+    if not source.get("features"):
+        return jsonify({"results": [], "message": "此紀錄尚無特徵向量"})
+
+    hits = _similar_index().query(
+        source["features"], k=k, exclude_id=record_id,
+        patient_id=source.get("patient_id") if scope == "same" else None,
+        exclude_patient=source.get("patient_id") if scope == "others" else None,
+    )
+    try:
+        # 一次查回命中的紀錄；其他 worker 已刪除的紀錄自然缺席
+        docs = {str(d["_id"]): d for d in records_collection.find(
+            {"_id": {"$in": [ObjectId(rid) for rid, _, _ in hits]}},
+            {"features": 0, "variant_public_ids": 0},
+        )}
+    except Exception as e:
+        return jsonify({"error": "查詢失敗", "detail": str(e)}), 500
+
+    results = []
+    for rid, _, distance in hits:
+        doc = docs.get(rid)
+        if doc is None:
+            continue
+        if doc.get("patient_id") != source.get("patient_id"):
+            # 其他病患的紀錄只回傳去識別化的診斷結果（無病患 ID、紀錄 ID、圖片網址）
+            results.append(_anonymous_case(doc, distance))
+            continue
+        doc["_id"] = rid
+        doc["timestamp"] = doc["timestamp"].strftime("%Y-%m-%d %H:%M:%S") if doc.get("timestamp") else ""
+        doc["distance"] = round(distance, 2)
+        results.append(_with_variants(doc))
+    return jsonify({"results": results})
+
+_ANONYMOUS_FIELDS = ("main_color", "region_codes", "ruleset_v", "five_regions")
+
+def _anonymous_case(doc, distance):
+    case = {k: doc[k] for k in _ANONYMOUS_FIELDS if k in doc}
+    case["timestamp"] = doc["timestamp"].strftime("%Y-%m-%d") if doc.get("timestamp") else ""
+    case["distance"] = round(distance, 2)
+    return case
+
 # =========================
 # 教學頁
 # =========================
@@ -297,48 +723,97 @@ def _get_mongo_collection():
     return db.get_collection("practice_questions")
 
 
+# ---- 題目存在伺服器端，cookie 只放題目 ID；每位使用者預先備好下一題 ----
+quiz_store = QuizSessionStore(
+    ttl=int(os.environ.get("QUIZ_SESSION_TTL", "3600")),
+    collection=(mongo_db.get_collection("quiz_sessions")
+                if mongo_db is not None and os.environ.get("QUIZ_SESSION_MONGO") == "1" else None),
+)
+try:
+    quiz_store.ensure_indexes()
+except Exception:
+    pass
+
+def _generate_quiz_question():
+    root = os.environ.get("CLOUD_TONGUE_ROOT", "home")
+    return get_random_cloudinary_question(root_folder=root)
+
+# 預備題目的存放上限：要短於簽名網址的有效期（至少一個 CLOUD_SIGNED_URL_WINDOW）與 quiz_store 的 TTL
+quiz_prefetcher = QuizPrefetcher(_generate_quiz_question,
+                                 depth=int(os.environ.get("QUIZ_PREFETCH_DEPTH", "2")),
+                                 max_age=min(float(os.environ.get("QUIZ_PREFETCH_MAX_AGE", "600")), quiz_store.ttl))
+
+def _quiz_uid():
+    uid = session.get("quiz_uid")
+    if not uid:
+        uid = session["quiz_uid"] = uuid.uuid4().hex
+    return uid
+
+def _header_url(value):
+    """header 只能放 latin-1：非 ASCII 字元轉成 %XX（已編碼的部分保持不變）。"""
+    return quote(value, safe=" :/?#[]@!$&'()*+,;=%~")
+
+def _with_next_preload(resp, uid):
+    """以 Link header 預載下一題圖片。"""
+    nxt = quiz_prefetcher.peek(uid)
+    url = (nxt or {}).get("image_url")
+    if url:
+        link = f'<{_header_url(url)}>; rel=preload; as=image'
+        if nxt.get("srcset"):
+            link += f'; imagesrcset="{_header_url(nxt["srcset"])}"; imagesizes="(max-width: 600px) 100vw, 480px"'
+        resp.headers["Link"] = link
+    return resp
+
 @app.route("/quiz")
 def quiz():
     """（Cloudinary Search 版）直接從 Cloudinary 的根資料夾隨機抽圖出題。
     根資料夾預設為環境變數 CLOUD_TONGUE_ROOT（預設 'home'）。
-    會將題目放入 session['practice_cloudinary'] 以便提交時比對。
+    題目存在 quiz_store，session 只保存 practice_qid 以便提交時比對。
     """
-    import os
-    root = os.environ.get("CLOUD_TONGUE_ROOT", "home")
-    q = get_random_cloudinary_question(root_folder=root)
-    session["practice_cloudinary"] = q
+    uid = _quiz_uid()
+    q = quiz_prefetcher.next(uid)
+    quiz_store.put(q["qid"], q)
+    session["practice_qid"] = q["qid"]
+    session.pop("practice_cloudinary", None)
     question_payload = {
         "question": "請判斷此舌象類別",
         "image_url": q.get("image_url", ""),
+        "srcset": q.get("srcset", ""),
         "choices": q.get("choices", [])
     }
-    return render_template(
+    resp = make_response(render_template(
         "practice.html",
         qid="",
         question=question_payload,
-    )
+    ))
+    return _with_next_preload(resp, uid)
 
 @app.route("/submit_practice_answer", methods=["POST"])
 def submit_practice_answer():
-    """優先驗證 Cloudinary 題目（session）；有 qid 時才回退舊 Mongo 題庫。"""
+    """優先驗證 Cloudinary 題目（伺服器端暫存）；有 qid 時才回退舊 Mongo 題庫。"""
     from bson import ObjectId
     data = request.form or request.json or {}
     user_answer = data.get("answer")
     qid = (data.get("qid") or "").strip()
 
-    sess_q = session.get("practice_cloudinary")
-    if sess_q and not qid:
+    sess_q = None
+    if not qid:
+        sess_qid = session.pop("practice_qid", None)
+        sess_q = quiz_store.pop(sess_qid) if sess_qid else None
+        # 舊版 cookie（整題放在 session）
+        sess_q = sess_q or session.pop("practice_cloudinary", None)
+    if sess_q:
         correct = sess_q.get("category", "")
         is_correct = (user_answer == correct)
         explanation = sess_q.get("explanation", "")
-        session.pop("practice_cloudinary", None)
-        return render_template(
+        resp = make_response(render_template(
             "result.html",
             user_answer=user_answer or "",
             correct_answer=correct,
             explanation=explanation,
             is_correct=is_correct,
-        )
+        ))
+        return _with_next_preload(resp, _quiz_uid())
 
     # 回退：Mongo 題庫（若仍保留）
     try:
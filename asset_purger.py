@@ -0,0 +1,146 @@
+import atexit, heapq, queue, re, threading, time
+from typing import Callable, Iterable, List, Optional
+import image_storage
+
+# ------------------------------------------------------------------
+# Background purge of deleted records' image assets
+# ------------------------------------------------------------------
+# Deleting a record only removes the DB document on the request path; the
+# asset public_ids are queued here and removed by one worker thread that
+# batches them into bulk-delete calls on the storage backend (Cloudinary
+# accepts up to 100 public_ids per delete_resources call), retrying failed
+# ids with exponential backoff.  A failed id waits in a not-before heap
+# instead of sleeping the worker, so it never delays the other deletes.
+# ------------------------------------------------------------------
+
+MAX_BATCH = 100
+
+
+def _storage_delete(public_ids: List[str]) -> List[str]:
+    """Delete a batch on the configured backend; return ids needing a retry."""
+    return image_storage.get_storage().delete(public_ids)
+
+
+# https://res.cloudinary.com/<cloud>/image/upload/[<transformations>/]v123/<public_id>.<ext>
+_CLD_PUBLIC_ID = re.compile(r"/(?:image|raw|video)/upload/(?:.*?/)?v\d+/(.+?)(?:\.\w+)?$")
+
+
+def public_id_from_url(url: str) -> Optional[str]:
+    """Recover the public_id (including folders) from a Cloudinary delivery URL."""
+    m = _CLD_PUBLIC_ID.search(url or "")
+    return m.group(1) if m else None
+
+
+def asset_ids(record: dict) -> List[str]:
+    """All asset public_ids owned by a record (original + stored variants)."""
+    ids = []
+    pid = record.get("public_id") or public_id_from_url(record.get("image_url", ""))
+    if pid:
+        ids.append(pid)
+    ids.extend(p for p in (record.get("variant_public_ids") or []) if p)
+    return ids
+
+
+class AssetPurger:
+    def __init__(self, delete_batch: Callable[[List[str]], List[str]] = None,
+                 batch_size: int = MAX_BATCH, max_attempts: int = 5,
+                 linger: float = 0.5, backoff: float = 1.0):
+        self.delete_batch = delete_batch or _storage_delete
+        self.batch_size = min(batch_size, MAX_BATCH)
+        self.max_attempts = max_attempts
+        self.linger = linger      # wait this long to fill a batch
+        self.backoff = backoff
+        self._q: "queue.Queue[tuple]" = queue.Queue()
+        self._delayed: List[tuple] = []  # (not_before, pid, attempts); worker thread only
+        self._thread = None
+        self._lock = threading.Lock()
+        self.purged = 0
+        self.failed = 0
+
+    def enqueue(self, public_ids: Iterable[str]):
+        n = 0
+        for pid in public_ids:
+            if pid:
+                self._q.put((pid, 0))
+                n += 1
+        if n:
+            self._ensure_worker()
+        return n
+
+    def pending(self) -> int:
+        return self._q.qsize()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Block until the queue is drained (or timeout); True if drained."""
+        deadline = None if timeout is None else time.time() + timeout
+        while self._q.unfinished_tasks:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="asset-purger", daemon=True)
+                self._thread.start()
+
+    def _due(self) -> List[tuple]:
+        now = time.time()
+        due = []
+        while self._delayed and self._delayed[0][0] <= now and len(due) < self.batch_size:
+            _, pid, n = heapq.heappop(self._delayed)
+            due.append((pid, n))
+        return due
+
+    def _next_batch(self) -> List[tuple]:
+        batch = self._due()
+        if not batch:
+            # 沒有到期的重試時才阻塞，最多等到下一筆重試到期
+            timeout = max(0.0, self._delayed[0][0] - time.time()) if self._delayed else None
+            try:
+                batch.append(self._q.get(timeout=timeout))
+            except queue.Empty:
+                return []
+        deadline = time.time() + self.linger
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            attempts = {pid: n for pid, n in batch}
+            try:
+                retry = self.delete_batch(list(attempts))
+            except Exception:
+                retry = list(attempts)
+            retry = set(retry or [])
+            self.purged += len(attempts) - len(retry)
+
+            now = time.time()
+            delayed = 0
+            for pid in retry:
+                n = attempts[pid] + 1
+                if n >= self.max_attempts:
+                    self.failed += 1
+                    print(f"⚠️ 無法刪除雲端圖片 {pid}（已重試 {n} 次）")
+                else:
+                    # 仍算未完成的工作（flush 會等它），到期後再併入下一批
+                    heapq.heappush(self._delayed, (now + self.backoff * (2 ** (n - 1)), pid, n))
+                    delayed += 1
+            for _ in range(len(batch) - delayed):
+                self._q.task_done()
+
+
+purger = AssetPurger()
+# 關機前盡量把佇列刪完，避免遺留雲端圖片
+atexit.register(lambda: purger.flush(timeout=10))
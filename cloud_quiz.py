@@ -1,6 +1,9 @@
-import os, random
+import os, random, itertools
 import cloudinary
 import cloudinary.api
+import quiz_manifest
+import image_storage
+from cloud_quiz_search import _is_displayable
 
 # Configure is expected to be done elsewhere (e.g., in app.py via env vars)
 # Required envs: CLOUD_NAME, CLOUD_API_KEY, CLOUD_API_SECRET
@@ -14,12 +17,10 @@ def _norm_root(root: str) -> str:
     return root or "home"
 
 def _list_categories_via_subfolders(root_folder: str):
-    """Try Cloudinary 'subfolders' API."""
+    """Try the storage backend's subfolder listing (Cloudinary 'subfolders' API)."""
     try:
-        resp = cloudinary.api.subfolders(root_folder)
         names = []
-        for sf in resp.get("folders", []):
-            name = sf.get("name") or ""
+        for name in image_storage.get_storage().subfolders(root_folder):
             # name often looks like "home/白苔"; convert to leaf after the root
             parts = name.split("/", 1)
             leaf = parts[1] if len(parts) == 2 else parts[0]
@@ -30,25 +31,36 @@ def _list_categories_via_subfolders(root_folder: str):
         return []
 
 def _list_categories_via_resources(root_folder: str, max_results: int = 500):
-    """Fallback: list resources under root and infer first-level subfolders."""
+    """Fallback: list resources under root and infer first-level subfolders.
+
+    Follows next_cursor so categories beyond the first page are found too.
+    """
     try:
         prefix = f"{root_folder}/"
-        resp = cloudinary.api.resources(
-            type="upload",
-            prefix=prefix,
-            resource_type="image",
-            max_results=max_results,
-            context=False
-        )
         cats = set()
-        for r in resp.get("resources", []):
-            public_id = r.get("public_id", "")
-            # public_id can look like "home/白苔/img123" or "home/白苔/sub/img"
-            if public_id.startswith(prefix):
-                tail = public_id[len(prefix):]  # "白苔/img123"
-                parts = tail.split("/", 1)
-                if parts and parts[0]:
-                    cats.add(parts[0])
+        cursor = None
+        while True:
+            params = dict(
+                type="upload",
+                prefix=prefix,
+                resource_type="image",
+                max_results=max_results,
+                context=False
+            )
+            if cursor:
+                params["next_cursor"] = cursor
+            resp = cloudinary.api.resources(**params)
+            for r in resp.get("resources", []):
+                public_id = r.get("public_id", "")
+                # public_id can look like "home/白苔/img123" or "home/白苔/sub/img"
+                if public_id.startswith(prefix):
+                    tail = public_id[len(prefix):]  # "白苔/img123"
+                    parts = tail.split("/", 1)
+                    if parts and parts[0]:
+                        cats.add(parts[0])
+            cursor = resp.get("next_cursor")
+            if not cursor:
+                break
         return list(cats)
     except Exception:
         return []
@@ -62,15 +74,15 @@ def _list_categories(root_folder: str):
 
 def _random_resource_from_category(cat: str, root_folder: str, max_results: int = 100):
     root_folder = _norm_root(root_folder)
-    prefix = f"{root_folder}/{cat}/"
-    resp = cloudinary.api.resources(
-        type="upload",
-        prefix=prefix,
-        resource_type="image",
-        max_results=max_results,
-        context=True
-    )
-    resources = resp.get("resources", [])
+    # Prefer the local manifest: uniform over ALL images, no network call.
+    try:
+        hit = quiz_manifest.pick([root_folder], [cat])
+    except Exception:
+        hit = None
+    if hit:
+        return hit[1]
+    folder = f"{root_folder}/{cat}"
+    resources = list(itertools.islice(image_storage.get_storage().list_prefix(folder), max_results))
     if not resources:
         return None
     return random.choice(resources)
@@ -95,6 +107,13 @@ def get_random_cloudinary_question(root_folder: str = DEFAULT_ROOT, fallback_cat
     if not cats:
         cats = list(fallback_categories)
 
+    # Keep the local manifest fresh (background, non-blocking)
+    try:
+        # same filter as cloud_quiz_search: both write the shared manifest
+        quiz_manifest.ensure_fresh([root_folder], cats, keep=_is_displayable)
+    except Exception:
+        pass
+
     # Pick a category first (uniform over categories)
     cat = random.choice(cats)
 
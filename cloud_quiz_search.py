@@ -1,10 +1,13 @@
 
-import os, random, time
+import os, random, time, threading, itertools
+from collections import OrderedDict
 from typing import List, Dict, Any
 import cloudinary
 import cloudinary.api
-from cloudinary.search import Search
 from cloudinary.utils import cloudinary_url
+import quiz_manifest
+import image_storage
+import image_variants
 
 # ------------------------------------------------------------------
 # Root configuration
@@ -54,16 +57,78 @@ def _is_displayable(r: Dict[str, Any]) -> bool:
         return fmt in _IMG_EXTS and typ in {"upload", "private"}
     return False
 
-def _build_secure_url(public_id: str, rt: str, typ: str) -> str:
+# ------------------------------------------------------------------
+# Signed URL cache (private assets)
+# ------------------------------------------------------------------
+# A fresh expiry per request gives every view a different URL, so neither
+# the browser nor the CDN can cache the image.  Expiries are snapped to
+# fixed windows instead: all requests inside one window share the same
+# expires_at (hence the same URL), and the URL is reused until it gets
+# close to expiry, then rotated.  Bounded LRU keyed by asset.
+#
+# Envs:
+#   CLOUD_SIGNED_URL_WINDOW      window length in seconds (default 3600)
+#   CLOUD_SIGNED_URL_MIN_TTL     rotate when less than this is left (default 600)
+#   CLOUD_SIGNED_URL_CACHE_SIZE  max cached URLs (default 2048)
+# ------------------------------------------------------------------
+
+_SIGN_WINDOW = int(os.environ.get("CLOUD_SIGNED_URL_WINDOW", "3600"))
+_SIGN_MIN_TTL = int(os.environ.get("CLOUD_SIGNED_URL_MIN_TTL", "600"))
+_SIGN_CACHE_SIZE = int(os.environ.get("CLOUD_SIGNED_URL_CACHE_SIZE", "2048"))
+
+class _SignedUrlCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (url, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key, now: float):
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is None:
+                return None
+            if hit[1] - now < _SIGN_MIN_TTL:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return hit[0]
+
+    def put(self, key, url: str, expires_at: int):
+        with self._lock:
+            self._items[key] = (url, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+_signed_urls = _SignedUrlCache(_SIGN_CACHE_SIZE)
+
+def _bucketed_expiry(now: float) -> int:
+    # end of the current window + one full window => lifetime in (W, 2W]
+    return (int(now) // _SIGN_WINDOW + 2) * _SIGN_WINDOW
+
+def _build_secure_url(public_id: str, rt: str, typ: str, variant: str = None) -> str:
+    storage = image_storage.get_storage()
+    if storage.name != "cloudinary":
+        return storage.url(public_id, variant=variant)
     params = dict(secure=True)
-    # private assets require a signed URL; set a reasonable expiry
+    if variant:
+        params.update(image_variants.cloudinary_variant_options(variant))
+    key = None
+    # private assets require a signed URL; reuse it within its expiry window
     if typ == "private":
+        now = time.time()
+        key = (public_id, rt, typ, variant)
+        cached = _signed_urls.get(key, now)
+        if cached:
+            return cached
         params["sign_url"] = True
-        params["expires_at"] = int(time.time()) + 3600  # 1 hour
+        params["expires_at"] = _bucketed_expiry(now)
     if rt == "image":
         url, _ = cloudinary_url(public_id, type=typ, **params)
     else:
         url, _ = cloudinary_url(public_id, resource_type=rt, type=typ, **params)
+    if key is not None and url:
+        _signed_urls.put(key, url, params["expires_at"])
     return url
 
 def _folder_for(cat: str, root: str) -> str:
@@ -73,9 +138,8 @@ def _folder_for(cat: str, root: str) -> str:
 def _search_category(cat: str, root: str, max_results: int = 200) -> List[Dict[str, Any]]:
     """Search resources for a specific category under a given root."""
     folder = _folder_for(cat, root)
-    # Search API: folder="白苔" or folder="home/白苔"
-    res = Search().expression(f'folder="{folder}"').max_results(max_results).execute()
-    items = res.get("resources", []) or []
+    # Cloudinary: Search API folder="白苔" or folder="home/白苔"
+    items = list(itertools.islice(image_storage.get_storage().list_prefix(folder), max_results))
     # keep only displayable
     items = [r for r in items if _is_displayable(r)]
     return items
@@ -105,6 +169,8 @@ def get_random_cloudinary_question(root_folder: str = None, fallback_categories=
     The dict format:
     {
       "image_url": <str>,
+      "image_variants": {"thumb": <str>, "medium": <str>},
+      "srcset": <str>,
       "public_id": <str>,
       "category": <str>,  # correct answer
       "choices": [<str>, <str>, ...],
@@ -118,6 +184,20 @@ def get_random_cloudinary_question(root_folder: str = None, fallback_categories=
     # Determine roots to search. Default: BOTH 'home' and root-level.
     roots = _parse_roots(default_roots=["home", ""])
 
+    # Fast path: uniform pick from the local manifest (no network call).
+    # Stale/empty manifests are refreshed in the background.
+    try:
+        quiz_manifest.ensure_fresh(roots, fallback_categories, keep=_is_displayable)
+        hit = quiz_manifest.pick(roots, fallback_categories)
+    except Exception:
+        hit = None
+    if hit:
+        cat, r = hit
+        picked = _pick_item([r])
+        if picked:
+            return _build_question(cat, picked[0], picked[1], fallback_categories,
+                                   "此題由本機題庫索引隨機抽取（涵蓋資料夾內所有圖片）。")
+
     # Aggregate available items per category across roots
     per_cat: Dict[str, List[Dict[str, Any]]] = {c: [] for c in fallback_categories}
     for root in roots:
@@ -161,9 +241,27 @@ def get_random_cloudinary_question(root_folder: str = None, fallback_categories=
         }
 
     r, url = picked
+    return _build_question(cat, r, url, fallback_categories,
+                           "此題由 Cloudinary 隨機抽取（支援根目錄與 home/ 資料夾）。")
+
+def _build_variants(r: Dict[str, Any]) -> Dict[str, str]:
+    """Thumbnail/medium URLs for an image asset (raw assets can't be transformed)."""
+    rt = (r.get("resource_type") or "image").lower()
+    if rt != "image":
+        return {}
+    pid = r.get("public_id", "")
+    typ = (r.get("type") or "upload").lower()
+    try:
+        urls = {name: _build_secure_url(pid, rt, typ, variant=name) for name in image_variants.VARIANTS}
+    except Exception:
+        return {}
+    return {name: url for name, url in urls.items() if url}
+
+def _build_question(cat: str, r: Dict[str, Any], url: str, categories, explanation: str):
     public_id = r.get("public_id", "")
+    variants = _build_variants(r)
     # Build choices (ensure correct answer present)
-    choices = list(dict.fromkeys(fallback_categories))  # keep order unique
+    choices = list(dict.fromkeys(categories))  # keep order unique
     random.shuffle(choices)
     choices = choices[:4] if len(choices) >= 4 else choices
     if cat not in choices:
@@ -171,10 +269,10 @@ def get_random_cloudinary_question(root_folder: str = None, fallback_categories=
         choices[idx] = cat
         random.shuffle(choices)
 
-    explanation = "此題由 Cloudinary 隨機抽取（支援根目錄與 home/ 資料夾）。"
-
     return {
         "image_url": url,
+        "image_variants": variants,
+        "srcset": image_variants.build_srcset(variants, url, r.get("width")),
         "public_id": public_id,
         "category": cat,
         "choices": choices,
@@ -33,13 +33,25 @@ def diagnose_region(L, A, B):
     else:
         return "無明顯症狀"
 
-def analyze_tongue_regions(image_path):
-    img = cv2.imread(image_path)
-    if img is None:
-        raise FileNotFoundError(f"找不到圖片: {image_path}")
+def extract_tongue_mask(image):
+    """uint8 mask of red-ish (tongue) pixels of a BGR image."""
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    lower_red1 = np.array([0, 50, 50])
+    upper_red1 = np.array([10, 255, 255])
+    lower_red2 = np.array([160, 50, 50])
+    upper_red2 = np.array([180, 255, 255])
+    mask1 = cv2.inRange(hsv, lower_red1, upper_red1)
+    mask2 = cv2.inRange(hsv, lower_red2, upper_red2)
+    return cv2.bitwise_or(mask1, mask2)
 
-    img_lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-    h, w, _ = img.shape
+def decode_image_bytes(data):
+    """Decode encoded image bytes (JPEG/PNG/...) to a BGR array, or None."""
+    if not data:
+        return None
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def _region_results(img_lab):
+    h, w, _ = img_lab.shape
 
     rois = {
         "心": img_lab[0:h//3, w//3:2*w//3],
@@ -49,29 +61,59 @@ def analyze_tongue_regions(image_path):
         "腎": img_lab[2*h//3:h, w//3:2*w//3],
     }
 
-    results = {}
-    for region, roi_lab in rois.items():
-        avg_lab = np.mean(roi_lab.reshape(-1, 3), axis=0)
-        L, A, B = avg_lab
-        diagnosis = diagnose_region(L, A, B)
-        advice = REGION_ADVICE_RULE.get(region, {}).get(diagnosis, "保持良好作息")
+    return {region: _region_entry(region, np.mean(roi_lab.reshape(-1, 3), axis=0))
+            for region, roi_lab in rois.items()}
 
-        results[region] = {
-            "區域": region,
-            "診斷": diagnosis,
-            "理論": REGION_THEORY.get(region, "無理論"),
-            "建議": advice
-        }
+def _region_entry(region, avg_lab):
+    L, A, B = avg_lab
+    diagnosis = diagnose_region(L, A, B)
+    advice = REGION_ADVICE_RULE.get(region, {}).get(diagnosis, "保持良好作息")
+    return {
+        "區域": region,
+        "診斷": diagnosis,
+        "理論": REGION_THEORY.get(region, "無理論"),
+        "建議": advice
+    }
 
-    return results
+def _main_color(img_lab):
+    return _main_color_from_avg(np.mean(img_lab.reshape(-1, 3), axis=0))
 
-def analyze_image_color(image_path):
-    img = cv2.imread(image_path)
-    img_lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-    avg_lab = np.mean(img_lab.reshape(-1, 3), axis=0)
+def _main_color_from_avg(avg_lab):
     L, A, B = avg_lab
     if A > 145 and B < 150 and L > 120:
         main_color = "健康"
     else:
         main_color = "無明顯異常"
     return main_color, "舌苔判讀", "維持現狀即可", [int(c) for c in avg_lab]
+
+def analyze_tongue_regions(image_path):
+    img = cv2.imread(image_path)
+    if img is None:
+        raise FileNotFoundError(f"找不到圖片: {image_path}")
+    return _region_results(cv2.cvtColor(img, cv2.COLOR_BGR2LAB))
+
+def analyze_image_color(image_path):
+    img = cv2.imread(image_path)
+    return _main_color(cv2.cvtColor(img, cv2.COLOR_BGR2LAB))
+
+def analyze_image_color_array(img):
+    return _main_color(cv2.cvtColor(img, cv2.COLOR_BGR2LAB))
+
+def fit_max_side(img, max_side):
+    """Downscale so the longer side is at most max_side (never upscales)."""
+    h, w = img.shape[:2]
+    if not max_side or max(h, w) <= max_side:
+        return img
+    scale = max_side / max(h, w)
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+def analyze_image_array(img):
+    """Main colour + five regions on an already-decoded BGR image.
+
+    One LAB conversion shared by both analyses; returns
+    (main_color, comment, advice, avg_lab, regions).
+    """
+    img_lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+    main_color, comment, advice, avg_lab = _main_color(img_lab)
+    return main_color, comment, advice, avg_lab, _region_results(img_lab)
@@ -41,9 +41,33 @@ def diagnose_region(L, A, B):
     else:
         return "無明顯症狀"
 
+_overlay_cache = {}
+
+def _load_overlay(overlay_path):
+    # overlay 不會變動，讀一次即可
+    overlay_img = _overlay_cache.get(overlay_path)
+    if overlay_img is None:
+        overlay_img = cv2.imread(overlay_path)
+        if overlay_img is not None:
+            _overlay_cache[overlay_path] = overlay_img
+    return overlay_img
+
 def analyze_tongue_regions_with_overlay(photo_path, overlay_path="static/TongueOverlay.png"):
     tongue_img = cv2.imread(photo_path)
-    overlay_img = cv2.imread(overlay_path)
+    if tongue_img is None:
+        raise FileNotFoundError("圖像或 overlay 讀取失敗")
+    return analyze_tongue_regions_with_overlay_array(tongue_img, overlay_path)
+
+def analyze_tongue_regions_with_overlay_array(tongue_img, overlay_path="static/TongueOverlay.png"):
+    return analyze_tongue_regions_with_overlay_stats(tongue_img, overlay_path)[0]
+
+def analyze_tongue_regions_with_overlay_stats(tongue_img, overlay_path="static/TongueOverlay.png"):
+    """Regions plus per-region LAB statistics.
+
+    Returns (regions, stats) where stats = {區域: (mean[3], std[3], pixels)}
+    and also holds the whole image under "整體".
+    """
+    overlay_img = _load_overlay(overlay_path)
 
     if tongue_img is None or overlay_img is None:
         raise FileNotFoundError("圖像或 overlay 讀取失敗")
@@ -51,29 +75,32 @@ def analyze_tongue_regions_with_overlay(photo_path, overlay_path="static/TongueO
     if tongue_img.shape != overlay_img.shape:
         overlay_img = cv2.resize(overlay_img, (tongue_img.shape[1], tongue_img.shape[0]))
 
+    tongue_lab = cv2.cvtColor(tongue_img, cv2.COLOR_BGR2LAB)
+    mean, std = cv2.meanStdDev(tongue_lab)
+    stats = {"整體": (mean.ravel(), std.ravel(), tongue_lab.shape[0] * tongue_lab.shape[1])}
     result = []
 
     for bgr_color, region in COLOR_TO_REGION.items():
         mask = cv2.inRange(overlay_img, np.array(bgr_color), np.array(bgr_color))
-        mask_indices = np.where(mask == 255)
+        count = cv2.countNonZero(mask)
 
-        if len(mask_indices[0]) == 0:
+        if count == 0:
             continue
 
-        tongue_lab = cv2.cvtColor(tongue_img, cv2.COLOR_BGR2LAB)
-        selected_pixels = tongue_lab[mask_indices]
-        avg_lab = np.mean(selected_pixels, axis=0)
-        L, A, B = avg_lab
-
-        diagnosis = diagnose_region(L, A, B)
-        theory = REGION_THEORY.get(region, "無理論")
-        advice = REGION_ADVICE_RULE.get(region, {}).get(diagnosis, REGION_ADVICE_RULE[region].get("其他", "保持良好作息"))
+        mean, std = cv2.meanStdDev(tongue_lab, mask=mask)
+        stats[region] = (mean.ravel(), std.ravel(), count)
+        result.append(_region_entry(region, mean.ravel()))
 
-        result.append({
-            "區域": region,
-            "診斷": diagnosis,
-            "理論": theory,
-            "建議": advice
-        })
+    return result, stats
 
-    return result
+def _region_entry(region, avg_lab):
+    L, A, B = avg_lab
+    diagnosis = diagnose_region(L, A, B)
+    theory = REGION_THEORY.get(region, "無理論")
+    advice = REGION_ADVICE_RULE.get(region, {}).get(diagnosis, REGION_ADVICE_RULE[region].get("其他", "保持良好作息"))
+    return {
+        "區域": region,
+        "診斷": diagnosis,
+        "理論": theory,
+        "建議": advice
+    }
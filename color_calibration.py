@@ -0,0 +1,151 @@
+import datetime, os, re, threading, time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from color_analysis import fit_max_side
+
+# ------------------------------------------------------------------
+# Per-device colour calibration
+# ------------------------------------------------------------------
+# Phones differ in white balance and tone, so the same tongue gives
+# different LAB readings.  A device (or clinic) calibrates once: it
+# photographs a white / grey card filling the centre of the frame, and
+# fit_profile() derives per-channel gains in linear light that turn the
+# card into a neutral grey of CALIBRATION_TARGET.  The profile is stored
+# in Mongo `calibration_profiles` (_id = device id).
+#
+# The gains are baked into a 256 x 3 lookup table, so correcting an
+# upload is one cv2.LUT pass over the analysis-size image (in place, no
+# float copies), instead of per-image statistics like grey-world.  A
+# single neutral reference only determines a diagonal transform, for
+# which a per-channel LUT is exact; a 3D LUT would add nothing.
+#
+# CalibrationStore caches the table per device for
+# CALIBRATION_CACHE_SECONDS (misses too), so uploads from other workers
+# pick up a refit within that interval.  The cache is an LRU of at most
+# CALIBRATION_CACHE_SIZE devices, since any client can send a device id.
+#
+# Envs:
+#   CALIBRATION_TARGET          sRGB level the reference card maps to (default 200)
+#   CALIBRATION_PATCH           centre share of the frame used as reference (default 0.5)
+#   CALIBRATION_CACHE_SECONDS   LUT cache lifetime (default 60)
+#   CALIBRATION_CACHE_SIZE      devices kept in the LUT cache (default 1024)
+# ------------------------------------------------------------------
+
+TARGET = float(os.environ.get("CALIBRATION_TARGET", "200"))
+PATCH = float(os.environ.get("CALIBRATION_PATCH", "0.5"))
+CACHE_SECONDS = float(os.environ.get("CALIBRATION_CACHE_SECONDS", "60"))
+CACHE_SIZE = int(os.environ.get("CALIBRATION_CACHE_SIZE", "1024"))
+
+MAX_SIDE = 512
+MIN_LEVEL, MAX_LEVEL = 30, 245
+MAX_VARIATION = 0.2
+MIN_GAIN, MAX_GAIN = 0.25, 4.0
+
+_DEVICE_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def valid_device_id(device_id: Optional[str]) -> bool:
+    return bool(device_id) and bool(_DEVICE_ID.match(device_id))
+
+
+def _to_linear(v):
+    v = np.asarray(v, np.float64)
+    return np.where(v <= 0.04045, v / 12.92, ((v + 0.055) / 1.055) ** 2.4)
+
+
+def _to_srgb(v):
+    v = np.asarray(v, np.float64)
+    return np.where(v <= 0.0031308, v * 12.92, 1.055 * np.power(v, 1 / 2.4) - 0.055)
+
+
+def fit_profile(img: np.ndarray) -> Dict[str, Any]:
+    """Per-channel linear gains from a reference frame; raises ValueError (Chinese message)."""
+    small = fit_max_side(img, MAX_SIDE)
+    h, w = small.shape[:2]
+    ph, pw = max(1, int(h * PATCH)), max(1, int(w * PATCH))
+    patch = small[(h - ph) // 2:(h + ph) // 2, (w - pw) // 2:(w + pw) // 2].reshape(-1, 3)
+
+    measured = np.median(patch, axis=0)  # B, G, R; robust to specks and glare spots
+    if measured.min() < MIN_LEVEL:
+        raise ValueError("參考畫面太暗，請在明亮處對準白卡")
+    if measured.max() > MAX_LEVEL:
+        raise ValueError("參考畫面過曝，請避免強光直射白卡")
+    gray = patch.mean(axis=1)
+    if gray.std() / max(1.0, gray.mean()) > MAX_VARIATION:
+        raise ValueError("參考畫面不均勻，請讓白卡填滿中央並避免陰影")
+
+    gains = _to_linear(TARGET / 255.0) / _to_linear(measured / 255.0)
+    if gains.min() < MIN_GAIN or gains.max() > MAX_GAIN:
+        raise ValueError("偏色過大，請確認拍攝的是白色或灰色卡片")
+    return {
+        "gains": [round(float(g), 4) for g in gains],
+        "measured": [round(float(m), 1) for m in measured],
+        "target": TARGET,
+    }
+
+
+def build_lut(gains) -> np.ndarray:
+    """(1, 256, 3) uint8 table applying linear-light gains to BGR levels."""
+    levels = _to_linear(np.arange(256) / 255.0)
+    out = [np.clip(_to_srgb(np.clip(levels * g, 0.0, 1.0)) * 255.0 + 0.5, 0, 255) for g in gains]
+    return np.stack(out, axis=-1).astype(np.uint8).reshape(1, 256, 3)
+
+
+def apply(img: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    """Correct a BGR image in place (one table lookup per pixel) and return it."""
+    return cv2.LUT(img, lut, dst=img)
+
+
+class CalibrationStore:
+    def __init__(self, collection=None, cache_seconds: float = CACHE_SECONDS, cache_size: int = CACHE_SIZE):
+        self.collection = collection
+        self.cache_seconds = cache_seconds
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, Tuple[float, Optional[Tuple[int, np.ndarray]]]]" = OrderedDict()
+
+    def get(self, device_id: str) -> Optional[Dict[str, Any]]:
+        if self.collection is None:
+            return None
+        return self.collection.find_one({"_id": device_id})
+
+    def lookup(self, device_id: str) -> Optional[Tuple[int, np.ndarray]]:
+        """(profile version, LUT) for a device, or None when it is not calibrated."""
+        if not valid_device_id(device_id) or self.collection is None:
+            return None
+        now = time.time()
+        with self._lock:
+            hit = self._cache.get(device_id)
+            if hit is not None and hit[0] > now:
+                self._cache.move_to_end(device_id)
+                return hit[1]
+        doc = self.get(device_id)
+        entry = (int(doc.get("version", 1)), build_lut(doc["gains"])) if doc and doc.get("gains") else None
+        with self._lock:
+            self._cache[device_id] = (now + self.cache_seconds, entry)
+            self._cache.move_to_end(device_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return entry
+
+    def save(self, device_id: str, profile: Dict[str, Any]) -> Dict[str, Any]:
+        self.collection.update_one(
+            {"_id": device_id},
+            {"$set": dict(profile, updated_at=datetime.datetime.utcnow()), "$inc": {"version": 1}},
+            upsert=True,
+        )
+        self.invalidate(device_id)
+        return self.get(device_id)
+
+    def delete(self, device_id: str) -> bool:
+        res = self.collection.delete_one({"_id": device_id})
+        self.invalidate(device_id)
+        return res.deleted_count > 0
+
+    def invalidate(self, device_id: str):
+        with self._lock:
+            self._cache.pop(device_id, None)
@@ -0,0 +1,103 @@
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from color_analysis_overlay import REGION_ADVICE_RULE, REGION_THEORY
+
+# ------------------------------------------------------------------
+# Coded five-region diagnoses
+# ------------------------------------------------------------------
+# Records used to embed the full 區域 / 診斷 / 理論 / 建議 strings for every
+# region (~700 bytes of repeated Chinese text per record).  They now store
+#
+#   region_codes  [[region_code, diagnosis_code], ...]
+#   ruleset_v     RULESET_VERSION at analysis time
+#
+# and the text lives in one ruleset table per version, served by
+# /ruleset/<v> with a long immutable cache lifetime and joined at render
+# time (history page, similar cases).
+#
+# Codes are indexes into REGIONS / DIAGNOSES.  Both lists are append-only
+# across versions, so a code means the same region / diagnosis forever;
+# only the theory / advice text is versioned.  Bump RULESET_VERSION (and
+# freeze the previous table in _FROZEN) whenever REGION_THEORY or
+# REGION_ADVICE_RULE in color_analysis_overlay change, so old records
+# keep showing the advice they were given.
+# ------------------------------------------------------------------
+
+RULESET_VERSION = 1
+REGIONS = ["脾胃", "肝膽", "腎", "心肺"]
+DIAGNOSES = ["健康", "偏黃", "白苔", "偏黑灰", "偏紅", "偏紫", "無明顯症狀"]
+
+_REGION_CODE = {name: i for i, name in enumerate(REGIONS)}
+_DIAGNOSIS_CODE = {name: i for i, name in enumerate(DIAGNOSES)}
+
+
+def _advice(region: str, diagnosis: str) -> str:
+    rules = REGION_ADVICE_RULE.get(region, {})
+    return rules.get(diagnosis, rules.get("其他", "保持良好作息"))
+
+
+def _build(version: int) -> Dict[str, Any]:
+    return {
+        "version": version,
+        "regions": REGIONS,
+        "diagnoses": DIAGNOSES,
+        "theory": [REGION_THEORY.get(r, "無理論") for r in REGIONS],
+        # advice[region_code][diagnosis_code]
+        "advice": [[_advice(r, d) for d in DIAGNOSES] for r in REGIONS],
+    }
+
+
+# 舊版規則表（改動文字後把上一版凍結在這裡）
+_FROZEN: Dict[int, Dict[str, Any]] = {}
+RULESETS: Dict[int, Dict[str, Any]] = {**_FROZEN, RULESET_VERSION: _build(RULESET_VERSION)}
+
+
+def ruleset(version: int) -> Optional[Dict[str, Any]]:
+    return RULESETS.get(version)
+
+
+def encode_regions(five_regions: Iterable[Dict[str, Any]]) -> Optional[List[List[int]]]:
+    """[{區域, 診斷, ...}] -> [[region_code, diagnosis_code]]; None if a name is unknown."""
+    codes = []
+    for r in five_regions:
+        rc, dc = _REGION_CODE.get(r.get("區域")), _DIAGNOSIS_CODE.get(r.get("診斷"))
+        if rc is None or dc is None:
+            return None
+        codes.append([rc, dc])
+    return codes
+
+
+def decode_regions(codes, version: int = RULESET_VERSION) -> List[Dict[str, str]]:
+    """Inverse of encode_regions with the text of the given ruleset."""
+    table = RULESETS.get(version) or RULESETS[RULESET_VERSION]
+    return [{
+        "區域": REGIONS[rc],
+        "診斷": DIAGNOSES[dc],
+        "理論": table["theory"][rc],
+        "建議": table["advice"][rc][dc],
+    } for rc, dc in codes]
+
+
+def compact_fields(five_regions) -> Dict[str, Any]:
+    """Record fields for a five_regions result (legacy text if it cannot be coded)."""
+    codes = encode_regions(five_regions)
+    if codes is None:
+        return {"five_regions": five_regions}
+    return {"region_codes": codes, "ruleset_v": RULESET_VERSION}
+
+
+def region_pairs(record: Dict[str, Any]) -> Iterator[Tuple[str, str]]:
+    """(區域, 診斷) of a coded or legacy record."""
+    codes = record.get("region_codes")
+    if codes:
+        for rc, dc in codes:
+            if 0 <= rc < len(REGIONS) and 0 <= dc < len(DIAGNOSES):
+                yield REGIONS[rc], DIAGNOSES[dc]
+        return
+    regions = record.get("five_regions") or []
+    if isinstance(regions, dict):
+        regions = list(regions.values())
+    for r in regions:
+        name, diag = r.get("區域"), r.get("診斷")
+        if name and diag:
+            yield name, diag
@@ -0,0 +1,251 @@
+import datetime
+from typing import Any, Dict, List, Optional
+from pymongo import UpdateOne
+
+from diagnosis_codes import DIAGNOSES, REGIONS, region_pairs
+
+# ------------------------------------------------------------------
+# Per-patient colour trends
+# ------------------------------------------------------------------
+# Each insert bumps one rollup document per (patient_id, unit, bucket) in
+# `record_rollups` (unit = day / week / month), holding the record count,
+# the LAB sums of `rgb` and per-region diagnosis counts.  /history_trend
+# reads only those documents, so its cost depends on the number of
+# buckets, not on the number of raw records.
+#
+# The same figures can be computed from raw records with an aggregation
+# pipeline ($dateTrunc, MongoDB 5.0+); it serves patients without rollups
+# yet and rebuilds the rollups via $merge.  Records may carry coded
+# diagnoses (region_codes) or the legacy five_regions text; both count.
+#
+# Rollups of a patient are only trusted once they cover all of the
+# patient's records, recorded by a marker document (unit "complete").
+# Patients whose records predate the rollups are served from raw records
+# until their first new upload backfills them; deletions never create
+# rollup documents (no upsert on sign=-1).
+# ------------------------------------------------------------------
+
+UNITS = ("day", "week", "month")
+COMPLETE_UNIT = "complete"
+_MARKER_BUCKET = datetime.datetime(1970, 1, 1)
+
+
+def bucket_start(ts: datetime.datetime, unit: str) -> datetime.datetime:
+    """Start of the bucket containing ts (UTC; weeks start on Monday)."""
+    day = datetime.datetime(ts.year, ts.month, ts.day)
+    if unit == "day":
+        return day
+    if unit == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    if unit == "month":
+        return day.replace(day=1)
+    raise ValueError(f"unknown unit: {unit}")
+
+
+def _region_counts(record: Dict[str, Any]) -> Dict[str, int]:
+    """{"regions.<區域>.<診斷>": n} for a record's diagnoses."""
+    out: Dict[str, int] = {}
+    for name, diag in region_pairs(record):
+        key = f"regions.{name}.{diag}"
+        out[key] = out.get(key, 0) + 1
+    return out
+
+
+def rollup_updates(record: Dict[str, Any], sign: int = 1) -> List[UpdateOne]:
+    """Upserts applying (sign=1) or reverting (sign=-1) a record in every unit."""
+    ts = record.get("timestamp")
+    patient_id = record.get("patient_id")
+    if not isinstance(ts, datetime.datetime) or not patient_id:
+        return []
+
+    inc: Dict[str, int] = {"n": sign}
+    lab = record.get("rgb") or []
+    if len(lab) == 3:
+        inc.update({"sum_L": sign * lab[0], "sum_A": sign * lab[1], "sum_B": sign * lab[2], "n_lab": sign})
+    for key, n in _region_counts(record).items():
+        inc[key] = sign * n
+
+    return [
+        UpdateOne(
+            {"patient_id": patient_id, "unit": unit, "bucket": bucket_start(ts, unit)},
+            {"$inc": inc},
+            upsert=sign > 0,
+        )
+        for unit in UNITS
+    ]
+
+
+def _marker(patient_id: str) -> Dict[str, Any]:
+    return {"patient_id": patient_id, "unit": COMPLETE_UNIT, "bucket": _MARKER_BUCKET}
+
+
+def is_complete(rollups, patient_id: str) -> bool:
+    """True once the patient's rollups cover all of their records."""
+    return rollups is not None and rollups.find_one(_marker(patient_id), {"_id": 1}) is not None
+
+
+def mark_complete(rollups, patient_id: str):
+    rollups.update_one(_marker(patient_id), {"$set": {"marked_at": datetime.datetime.utcnow()}}, upsert=True)
+
+
+def apply_rollup(rollups, record: Dict[str, Any], sign: int = 1, records=None):
+    """Apply / revert one record (already inserted / deleted in `records`).
+
+    For a patient without complete rollups nothing is incremented: a delete
+    is already reflected by the raw fallback, and an insert backfills the
+    patient from `records` first.  Best effort (trend data is derived).
+    """
+    ops = rollup_updates(record, sign)
+    if rollups is None or not ops:
+        return
+    patient_id = record["patient_id"]
+    try:
+        if is_complete(rollups, patient_id):
+            rollups.bulk_write(ops, ordered=False)
+        elif sign > 0 and records is not None:
+            if records.count_documents({"patient_id": patient_id}, limit=2) > 1:
+                rebuild_rollups(records, rollups, patient_id)  # 舊病患：由原始紀錄補齊
+            else:
+                rollups.delete_many({"patient_id": patient_id})
+                rollups.bulk_write(ops, ordered=False)
+                mark_complete(rollups, patient_id)
+    except Exception as e:
+        print(f"⚠️ 趨勢統計更新失敗：{e}")
+
+
+def ensure_indexes(rollups):
+    rollups.create_index([("patient_id", 1), ("unit", 1), ("bucket", 1)], unique=True)
+
+
+def _match(patient_id: Optional[str], start=None, end=None, field: str = "timestamp") -> Dict[str, Any]:
+    match: Dict[str, Any] = {}
+    if patient_id:
+        match["patient_id"] = patient_id
+    if start or end:
+        rng = {}
+        if start:
+            rng["$gte"] = start
+        if end:
+            rng["$lt"] = end
+        match[field] = rng
+    return match
+
+
+def trend_pipeline(unit: str, patient_id: Optional[str] = None, start=None, end=None) -> List[Dict[str, Any]]:
+    """Aggregate raw records into rollup-shaped documents."""
+    if unit not in UNITS:
+        raise ValueError(f"unknown unit: {unit}")
+
+    def _lab(i):
+        return {"$sum": {"$ifNull": [{"$arrayElemAt": ["$rgb", i]}, 0]}}
+
+    def _count(ri, di):
+        return {"$sum": {"$size": {"$filter": {"input": "$_dx", "cond": {"$eq": ["$$this", [ri, di]]}}}}}
+
+    # legacy five_regions text -> the same [region_code, diagnosis_code] pairs
+    coded = {"$concatArrays": [
+        {"$ifNull": ["$region_codes", []]},
+        {"$map": {"input": {"$ifNull": ["$five_regions", []]}, "in": [
+            {"$indexOfArray": [{"$literal": REGIONS}, "$$this.區域"]},
+            {"$indexOfArray": [{"$literal": DIAGNOSES}, "$$this.診斷"]},
+        ]}},
+    ]}
+
+    group: Dict[str, Any] = {
+        "_id": {"patient_id": "$patient_id",
+                "bucket": {"$dateTrunc": {"date": "$timestamp", "unit": unit, "startOfWeek": "monday"}}},
+        "n": {"$sum": 1},
+        "n_lab": {"$sum": {"$cond": [{"$eq": [{"$size": {"$ifNull": ["$rgb", []]}}, 3]}, 1, 0]}},
+        "sum_L": _lab(0), "sum_A": _lab(1), "sum_B": _lab(2),
+    }
+    regions_proj: Dict[str, Any] = {}
+    for ri, region in enumerate(REGIONS):
+        regions_proj[region] = {}
+        for di, diag in enumerate(DIAGNOSES):
+            group[f"r{ri}_{di}"] = _count(ri, di)
+            regions_proj[region][diag] = f"$r{ri}_{di}"
+
+    return [
+        {"$match": _match(patient_id, start, end)},
+        {"$project": {"patient_id": 1, "timestamp": 1, "rgb": 1, "_dx": coded}},
+        {"$group": group},
+        {"$project": {
+            "_id": 0,
+            "patient_id": "$_id.patient_id",
+            "unit": {"$literal": unit},
+            "bucket": "$_id.bucket",
+            "n": 1, "n_lab": 1, "sum_L": 1, "sum_A": 1, "sum_B": 1,
+            "regions": regions_proj,
+        }},
+        {"$sort": {"bucket": 1}},
+    ]
+
+
+def rebuild_rollups(records, rollups, patient_id: Optional[str] = None):
+    """Recompute rollups from raw records (migration / repair)."""
+    ensure_indexes(rollups)
+    rollups.delete_many(_match(patient_id))
+    for unit in UNITS:
+        pipeline = trend_pipeline(unit, patient_id)
+        pipeline.append({"$merge": {
+            "into": rollups.name,
+            "on": ["patient_id", "unit", "bucket"],
+            "whenMatched": "replace",
+            "whenNotMatched": "insert",
+        }})
+        records.aggregate(pipeline, allowDiskUse=True)
+    patients = [patient_id] if patient_id else records.distinct("patient_id")
+    for pid in patients:
+        if pid:
+            mark_complete(rollups, pid)
+
+
+def format_points(docs) -> List[Dict[str, Any]]:
+    """Rollup-shaped documents -> compact JSON points (zero counts dropped)."""
+    points = []
+    for d in docs:
+        n = d.get("n", 0)
+        if n <= 0:
+            continue
+        n_lab = d.get("n_lab", 0)
+        lab = [round(d.get(k, 0) / n_lab, 1) for k in ("sum_L", "sum_A", "sum_B")] if n_lab > 0 else None
+        regions = {}
+        for region, diags in (d.get("regions") or {}).items():
+            counts = {diag: c for diag, c in diags.items() if c > 0}
+            if counts:
+                regions[region] = counts
+        points.append({
+            "bucket": d["bucket"].strftime("%Y-%m-%d"),
+            "count": n,
+            "lab": lab,
+            "regions": regions,
+        })
+    return points
+
+
+def get_trend(records, rollups, patient_id: str, unit: str = "week", start=None, end=None) -> Dict[str, Any]:
+    """Trend points from rollups; falls back to aggregating raw records."""
+    if unit not in UNITS:
+        raise ValueError(f"unknown unit: {unit}")
+    if is_complete(rollups, patient_id):
+        source = "rollup"
+        query = _match(patient_id, start, end, field="bucket")
+        query["unit"] = unit
+        docs = list(rollups.find(query, {"_id": 0}).sort("bucket", 1))
+    else:
+        source = "raw"
+        docs = list(records.aggregate(trend_pipeline(unit, patient_id, start, end)))
+    return {"patient_id": patient_id, "unit": unit, "source": source, "points": format_points(docs)}
+
+
+if __name__ == "__main__":
+    # 重建趨勢統計：python history_trend.py [patient_id]
+    import os, sys
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    db = MongoClient(os.environ["MONGO_URI"]).get_database("tongueDB")
+    rebuild_rollups(db.get_collection("records"), db.get_collection("record_rollups"),
+                    sys.argv[1] if len(sys.argv) > 1 else None)
+    print("✅ 趨勢統計已重建")
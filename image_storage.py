@@ -0,0 +1,221 @@
+import io, os, uuid, datetime
+from typing import Any, Dict, Iterator, List, Optional
+from urllib.parse import quote
+
+import cloudinary
+import cloudinary.api
+import cloudinary.uploader
+from cloudinary.search import Search
+from cloudinary.utils import cloudinary_url
+
+import image_variants
+
+# ------------------------------------------------------------------
+# Image storage backends
+# ------------------------------------------------------------------
+# Everything that stores, lists or deletes images goes through one
+# ImageStorage object, selected by IMAGE_STORAGE:
+#
+#   cloudinary (default)  Cloudinary upload / Search / delete_resources
+#   local                 files under LOCAL_STORAGE_DIR (default "media"),
+#                         served by the app at LOCAL_STORAGE_URL ("/media")
+#                         with send_file (sendfile under gunicorn)
+#
+# Resources returned by list_prefix() use Cloudinary's resource dict keys
+# (public_id, resource_type, type, format, secure_url, created_at) so the
+# quiz code does not care which backend produced them.
+# ------------------------------------------------------------------
+
+
+class ImageStorage:
+    name = "base"
+    # True when the backend can serve resized variants of a stored image
+    supports_derivatives = False
+
+    def put(self, data: bytes, folder: str, eager: List[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Store an image; return {"public_id", "url", "width", "variants"}."""
+        raise NotImplementedError
+
+    def delete(self, public_ids: List[str]) -> List[str]:
+        """Delete a batch; return the ids that still need a retry."""
+        raise NotImplementedError
+
+    def list_prefix(self, folder: str, since: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Yield every resource directly inside `folder`, oldest first."""
+        raise NotImplementedError
+
+    def subfolders(self, folder: str) -> List[str]:
+        """Names of the direct subfolders of `folder`."""
+        raise NotImplementedError
+
+    def url(self, public_id: str, variant: str = None) -> str:
+        """Delivery URL of an image (or of one of its variants, "" if unsupported)."""
+        raise NotImplementedError
+
+
+class CloudinaryStorage(ImageStorage):
+    name = "cloudinary"
+    supports_derivatives = True
+    page_size = 500  # Search API maximum
+
+    def put(self, data, folder, eager=None):
+        params = dict(folder=folder)
+        if eager:
+            params["eager"] = eager
+        res = cloudinary.uploader.upload(io.BytesIO(data), **params)
+        return {
+            "public_id": res.get("public_id"),
+            "url": res.get("secure_url"),
+            "width": res.get("width"),
+            "variants": image_variants.variants_from_upload(res),
+        }
+
+    def delete(self, public_ids):
+        res = cloudinary.api.delete_resources(public_ids)
+        deleted = res.get("deleted") or {}
+        # "deleted" / "not_found" are both final
+        return [pid for pid in public_ids if deleted.get(pid) not in ("deleted", "not_found")]
+
+    def list_prefix(self, folder, since=None):
+        expr = f'folder="{folder}"'
+        if since:
+            # '>=' so nothing sharing the boundary timestamp is missed
+            expr += f' AND created_at>="{since}"'
+        cursor = None
+        while True:
+            q = Search().expression(expr).sort_by("created_at", "asc").max_results(self.page_size)
+            if cursor:
+                q = q.next_cursor(cursor)
+            res = q.execute()
+            for r in res.get("resources", []) or []:
+                yield r
+            cursor = res.get("next_cursor")
+            if not cursor:
+                break
+
+    def subfolders(self, folder):
+        resp = cloudinary.api.subfolders(folder)
+        return [sf.get("name") for sf in resp.get("folders", []) if sf.get("name")]
+
+    def url(self, public_id, variant=None):
+        params = dict(secure=True)
+        if variant:
+            params.update(image_variants.cloudinary_variant_options(variant))
+        url, _ = cloudinary_url(public_id, **params)
+        return url
+
+
+def _sniff_ext(data: bytes) -> str:
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    return "jpg"
+
+
+def _image_width(data: bytes) -> Optional[int]:
+    try:
+        from PIL import Image  # header only, no full decode
+        with Image.open(io.BytesIO(data)) as im:
+            return im.size[0]
+    except Exception:
+        return None
+
+
+class LocalStorage(ImageStorage):
+    """Files on local disk; public_id is the path relative to root (with extension)."""
+    name = "local"
+    supports_derivatives = False
+
+    def __init__(self, root: str = "media", url_prefix: str = "/media"):
+        self.root = os.path.realpath(root)
+        self.url_prefix = url_prefix.rstrip("/")
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, public_id: str) -> str:
+        path = os.path.realpath(os.path.join(self.root, public_id))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            raise ValueError(f"invalid public_id: {public_id}")
+        return path
+
+    def put(self, data, folder, eager=None):
+        folder = folder.strip("/")
+        public_id = f"{folder}/{uuid.uuid4().hex}.{_sniff_ext(data)}" if folder else f"{uuid.uuid4().hex}.{_sniff_ext(data)}"
+        path = self.path(public_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.part"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)  # readers never see a half-written file
+        return {"public_id": public_id, "url": self.url(public_id), "width": _image_width(data), "variants": {}}
+
+    def delete(self, public_ids):
+        for pid in public_ids:
+            try:
+                os.remove(self.path(pid))
+            except (FileNotFoundError, ValueError):
+                pass
+        return []
+
+    def list_prefix(self, folder, since=None):
+        base = self.path(folder.strip("/"))
+        if not os.path.isdir(base):
+            return
+        items = []
+        for entry in os.scandir(base):
+            if not entry.is_file() or entry.name.endswith(".part"):
+                continue
+            created = datetime.datetime.utcfromtimestamp(entry.stat().st_mtime).strftime("%Y-%m-%dT%H:%M:%SZ")
+            if since and created < since:
+                continue
+            public_id = os.path.relpath(entry.path, self.root).replace(os.sep, "/")
+            items.append({
+                "public_id": public_id,
+                "resource_type": "image",
+                "type": "upload",
+                "format": entry.name.rsplit(".", 1)[-1].lower() if "." in entry.name else "",
+                "secure_url": self.url(public_id),
+                "created_at": created,
+            })
+        items.sort(key=lambda r: r["created_at"])
+        yield from items
+
+    def subfolders(self, folder):
+        base = self.path(folder.strip("/")) if folder.strip("/") else self.root
+        if not os.path.isdir(base):
+            return []
+        return [e.name for e in os.scandir(base) if e.is_dir()]
+
+    def url(self, public_id, variant=None):
+        if variant:
+            return ""
+        # 資料夾可能是中文（home/白苔/...）：編碼後才能放進 Link 等 header
+        return f"{self.url_prefix}/{quote(public_id)}"
+
+
+_storage: Optional[ImageStorage] = None
+
+
+def from_env() -> ImageStorage:
+    kind = (os.environ.get("IMAGE_STORAGE") or "cloudinary").strip().lower()
+    if kind == "local":
+        return LocalStorage(os.environ.get("LOCAL_STORAGE_DIR", "media"),
+                            os.environ.get("LOCAL_STORAGE_URL", "/media"))
+    return CloudinaryStorage()
+
+
+def get_storage() -> ImageStorage:
+    global _storage
+    if _storage is None:
+        _storage = from_env()
+    return _storage
+
+
+def set_storage(storage: ImageStorage):
+    """Swap the backend (load tests / alternative deployments)."""
+    global _storage
+    _storage = storage
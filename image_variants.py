@@ -0,0 +1,92 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+import cv2
+
+# ------------------------------------------------------------------
+# Responsive image variants (thumbnail / medium)
+# ------------------------------------------------------------------
+# Uploads register eager Cloudinary transformations so the derived files
+# exist before the first view; their URLs are stored in the record as
+# {"thumb": url, "medium": url}.  Records/quiz images without stored
+# variants get them derived from the Cloudinary delivery URL, and storage
+# that cannot derive at all falls back to resizing locally.
+# ------------------------------------------------------------------
+
+# name -> max width in px (height follows aspect ratio)
+VARIANTS: Dict[str, int] = {"thumb": 320, "medium": 800}
+VARIANT_FORMAT = "webp"
+
+
+def _transformation(width: int) -> Dict[str, Any]:
+    return {"width": width, "crop": "limit", "quality": "auto"}
+
+
+def eager_transformations() -> List[Dict[str, Any]]:
+    """`eager=` argument for cloudinary.uploader.upload (same order as VARIANTS)."""
+    return [dict(_transformation(w), format=VARIANT_FORMAT) for w in VARIANTS.values()]
+
+
+def variants_from_upload(up_res: Dict[str, Any]) -> Dict[str, str]:
+    """Map eager results of an upload response back to variant names."""
+    eager = up_res.get("eager") or []
+    out = {}
+    for name, item in zip(VARIANTS, eager):
+        url = item.get("secure_url") or item.get("url")
+        if url:
+            out[name] = url
+    return out
+
+
+def cloudinary_variant_options(name: str) -> Dict[str, Any]:
+    """Extra cloudinary_url() options producing the given variant."""
+    return {"transformation": [_transformation(VARIANTS[name])], "format": VARIANT_FORMAT}
+
+
+# https://res.cloudinary.com/<cloud>/image/upload/[<transformations>/]v123/<public_id>.<ext>
+_CLD_URL = re.compile(r"^(https?://[^/]+/[^/]+/image/upload/)(.*?)(v\d+/.+?)(\.\w+)?$")
+
+
+def variants_from_url(url: str) -> Dict[str, str]:
+    """Derive variant URLs from a public Cloudinary delivery URL ({} if not one)."""
+    m = _CLD_URL.match(url or "")
+    if not m or m.group(2):
+        # not Cloudinary, or already transformed / signed
+        return {}
+    base, _, path, _ = m.groups()
+    out = {}
+    for name, width in VARIANTS.items():
+        out[name] = f"{base}c_limit,q_auto,w_{width}/{path}.{VARIANT_FORMAT}"
+    return out
+
+
+def build_srcset(variants: Dict[str, str], original_url: str = "",
+                 original_width: Optional[int] = None) -> str:
+    """`srcset` attribute value, smallest first.
+
+    Variants at least as wide as a known original are skipped (they were
+    never upscaled, so their nominal width would be wrong).
+    """
+    parts = [f"{variants[name]} {width}w" for name, width in VARIANTS.items()
+             if variants.get(name) and not (original_width and width >= original_width)]
+    if original_url and original_width:
+        parts.append(f"{original_url} {int(original_width)}w")
+    return ", ".join(parts)
+
+
+def resize_variants(img) -> Dict[str, Tuple[bytes, int]]:
+    """Local fallback: encode each variant from a decoded BGR image.
+
+    Returns {name: (encoded_bytes, width)}; never upscales.
+    """
+    h, w = img.shape[:2]
+    out = {}
+    for name, max_w in VARIANTS.items():
+        if w > max_w:
+            size = (max_w, max(1, round(h * max_w / w)))
+            small = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        else:
+            small = img
+        ok, buf = cv2.imencode(f".{VARIANT_FORMAT}", small, [cv2.IMWRITE_WEBP_QUALITY, 80])
+        if ok:
+            out[name] = (buf.tobytes(), small.shape[1])
+    return out
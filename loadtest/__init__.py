@@ -0,0 +1,3 @@
+# 離線壓力測試工具（本機替身取代圖片儲存 / MongoDB），用法見 __main__.py
+from .fakes import FakeStorage, Latency, MemoryCollection, make_fixture_image
+from .harness import install, run, seed_records, format_report
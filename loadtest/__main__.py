@@ -0,0 +1,64 @@
+"""離線壓力測試：python -m loadtest --duration 30 --concurrency 16
+
+以本機替身取代 Cloudinary / MongoDB（或 --mongo-uri 指向本機 mongod），
+輸出各端點的吞吐量與 p50/p95/p99 延遲。
+"""
+import argparse, json, logging, os, sys, threading
+
+from .fakes import Latency, make_fixture_image
+from .harness import DEFAULT_MIX, format_report, install, parse_mix, run, seed_records
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="python -m loadtest", description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--duration", type=float, default=30, help="measured seconds")
+    ap.add_argument("--warmup", type=float, default=3, help="unmeasured seconds before")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--mix", default=",".join(f"{k}={v}" for k, v in DEFAULT_MIX.items()),
+                    help="weighted endpoints, e.g. upload=1,quiz=4,history=4,practice=1,trend=1")
+    ap.add_argument("--patients", type=int, default=20)
+    ap.add_argument("--seed-records", type=int, default=30, help="records per patient before the run")
+    ap.add_argument("--image-size", default="960x1280", help="fixture WxH")
+    ap.add_argument("--cloud-latency-ms", type=float, default=0)
+    ap.add_argument("--db-latency-ms", type=float, default=0)
+    ap.add_argument("--jitter-ms", type=float, default=0)
+    ap.add_argument("--mongo-uri", default=None, help="use a local mongod instead of the in-memory store")
+    ap.add_argument("--json", dest="json_out", default=None, help="also write the report as JSON")
+    args = ap.parse_args(argv)
+
+    # 不連線正式環境
+    for key in ("MONGO_URI", "CLOUD_NAME", "CLOUD_API_KEY", "CLOUD_API_SECRET"):
+        os.environ.pop(key, None)
+    sys.path.insert(0, os.getcwd())
+    import app as app_module
+    from werkzeug.serving import make_server
+
+    install(app_module,
+            cloud_latency=Latency(args.cloud_latency_ms, args.jitter_ms),
+            db_latency=Latency(args.db_latency_ms, args.jitter_ms),
+            mongo_uri=args.mongo_uri)
+
+    w, h = (int(v) for v in args.image_size.lower().split("x"))
+    image_bytes = make_fixture_image(w, h)
+    patients = [f"loadtest-{i:04d}" for i in range(args.patients)]
+    seed_records(app_module, patients, args.seed_records, image_bytes)
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    try:
+        report = run(base, parse_mix(args.mix), args.concurrency, args.duration,
+                     patients, image_bytes, warmup=args.warmup)
+    finally:
+        server.shutdown()
+
+    print(format_report(report))
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+import copy, datetime, random, threading, time
+from types import SimpleNamespace
+from urllib.parse import quote
+from typing import Any, Dict, List, Optional
+
+import cv2
+import numpy as np
+from bson import ObjectId
+from pymongo import UpdateOne
+
+import image_variants
+from image_storage import ImageStorage
+
+# ------------------------------------------------------------------
+# Local stand-ins for the image storage backend and MongoDB
+# ------------------------------------------------------------------
+# Only the calls the app actually makes are implemented.  Every call can
+# sleep for an injected latency so WAN / Atlas round trips can be
+# simulated without leaving the machine.
+# ------------------------------------------------------------------
+
+
+class Latency:
+    """Sleep `ms` (+ uniform jitter) per call; 0 disables."""
+
+    def __init__(self, ms: float = 0.0, jitter: float = 0.0):
+        self.ms = ms
+        self.jitter = jitter
+
+    def __call__(self):
+        if self.ms or self.jitter:
+            time.sleep(max(0.0, self.ms + random.uniform(-self.jitter, self.jitter)) / 1000.0)
+
+
+def make_fixture_image(width: int = 960, height: int = 1280, seed: int = 0) -> bytes:
+    """Synthetic tongue-like JPEG (reddish ellipse on a dark background)."""
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), (40, 40, 40), np.uint8)
+    color = tuple(int(c) for c in rng.integers([90, 80, 170], [140, 130, 230]))
+    cv2.ellipse(img, (width // 2, height // 2), (width // 3, height // 2 - 40), 0, 0, 360, color, -1)
+    noise = rng.integers(-12, 12, img.shape, dtype=np.int16)
+    img = np.clip(img.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return buf.tobytes()
+
+
+# ------------------------------------------------------------------
+# Image storage
+# ------------------------------------------------------------------
+
+class FakeStorage(ImageStorage):
+    """In-memory ImageStorage with Cloudinary-style URLs and derived variants."""
+    name = "loadtest"
+    supports_derivatives = True
+
+    def __init__(self, latency: Latency = None, cloud_name: str = "loadtest",
+                 categories=("白苔", "黃苔", "灰黑苔", "紅紫舌無苔"), per_category: int = 200):
+        self.latency = latency or Latency()
+        self.cloud_name = cloud_name
+        self._lock = threading.Lock()
+        self._n = 0
+        self.assets: Dict[str, Dict[str, Any]] = {}
+        for cat in categories:
+            for i in range(per_category):
+                pid = f"home/{cat}/fixture_{i:05d}"
+                self.assets[pid] = self._resource(pid, "2024-01-01T00:00:00Z")
+
+    def _resource(self, public_id: str, created_at: str, width: int = 960, height: int = 1280):
+        return {
+            "public_id": public_id,
+            "resource_type": "image",
+            "type": "upload",
+            "format": "jpg",
+            "width": width,
+            "height": height,
+            "created_at": created_at,
+            "secure_url": self.url(public_id),
+        }
+
+    def put(self, data, folder, eager=None):
+        self.latency()
+        with self._lock:
+            self._n += 1
+            pid = f"{folder.strip('/')}/upload_{self._n:08d}".strip("/")
+            res = self._resource(pid, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+            self.assets[pid] = res
+        return {"public_id": pid, "url": res["secure_url"], "width": res["width"],
+                "variants": image_variants.variants_from_url(res["secure_url"]) if eager else {}}
+
+    def delete(self, public_ids):
+        self.latency()
+        with self._lock:
+            for pid in public_ids:
+                self.assets.pop(pid, None)
+        return []
+
+    def list_prefix(self, folder, since=None):
+        self.latency()
+        folder = folder.strip("/")
+        with self._lock:
+            items = sorted((dict(r) for pid, r in self.assets.items() if pid.rsplit("/", 1)[0] == folder),
+                           key=lambda r: r["created_at"])
+        return iter([r for r in items if not since or r["created_at"] >= since])
+
+    def subfolders(self, folder):
+        self.latency()
+        prefix = folder.strip("/") + "/"
+        with self._lock:
+            return sorted({pid[len(prefix):].split("/", 1)[0] for pid in self.assets
+                           if pid.startswith(prefix) and "/" in pid[len(prefix):]})
+
+    def url(self, public_id, variant=None):
+        url = f"https://res.cloudinary.com/{self.cloud_name}/image/upload/v1/{quote(public_id)}.jpg"
+        if variant:
+            return image_variants.variants_from_url(url).get(variant, "")
+        return url
+
+
+# ------------------------------------------------------------------
+# MongoDB
+# ------------------------------------------------------------------
+
+def _get(doc: Dict[str, Any], path: str):
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _matches(doc: Dict[str, Any], flt: Dict[str, Any]) -> bool:
+    for key, cond in (flt or {}).items():
+        val = _get(doc, key)
+        if isinstance(cond, dict) and any(k.startswith("$") for k in cond):
+            for op, arg in cond.items():
+                if op == "$in" and val not in arg:
+                    return False
+                if op == "$gt" and not (val is not None and val > arg):
+                    return False
+                if op == "$gte" and not (val is not None and val >= arg):
+                    return False
+                if op == "$lt" and not (val is not None and val < arg):
+                    return False
+                if op == "$exists" and (val is not None) != bool(arg):
+                    return False
+        elif val != cond:
+            return False
+    return True
+
+
+def _project(doc: Dict[str, Any], projection: Optional[Dict[str, int]]):
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    if any(v for v in projection.values()):
+        keep = {k for k, v in projection.items() if v}
+        keep.add("_id")
+        if projection.get("_id") == 0:
+            keep.discard("_id")
+        return {k: v for k, v in doc.items() if k in keep}
+    return {k: v for k, v in doc.items() if k not in projection}
+
+
+# ---- aggregation: the expression / stage subset of history_trend.trend_pipeline ----
+
+def _date_trunc(date, unit):
+    day = datetime.datetime(date.year, date.month, date.day)
+    if unit == "week":  # startOfWeek: monday
+        return day - datetime.timedelta(days=day.weekday())
+    if unit == "month":
+        return day.replace(day=1)
+    return day
+
+
+_EXPR_OPS = {
+    "$literal": lambda a, ev: a,
+    "$ifNull": lambda a, ev: next((v for v in map(ev, a) if v is not None), None),
+    "$arrayElemAt": lambda a, ev: (lambda arr, i: arr[i] if arr and -len(arr) <= i < len(arr) else None)(ev(a[0]), ev(a[1])),
+    "$size": lambda a, ev: len(ev(a)),
+    "$eq": lambda a, ev: ev(a[0]) == ev(a[1]),
+    "$cond": lambda a, ev: ev(a[1]) if ev(a[0]) else ev(a[2]),
+    "$concatArrays": lambda a, ev: [x for arr in a for x in ev(arr)],
+    "$indexOfArray": lambda a, ev: (lambda arr, v: arr.index(v) if v in arr else -1)(ev(a[0]), ev(a[1])),
+    "$dateTrunc": lambda a, ev: _date_trunc(ev(a["date"]), a["unit"]),
+}
+
+
+def _eval(expr, doc: Dict[str, Any], this=None):
+    def ev(e):
+        return _eval(e, doc, this)
+
+    if isinstance(expr, str) and expr.startswith("$$this"):
+        return _get(this, expr[7:]) if expr != "$$this" else this
+    if isinstance(expr, str) and expr.startswith("$"):
+        return _get(doc, expr[1:])
+    if isinstance(expr, list):
+        return [ev(e) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) == 1 and next(iter(expr)).startswith("$"):
+        op, arg = next(iter(expr.items()))
+        if op == "$filter":
+            return [x for x in ev(arg["input"]) if _eval(arg["cond"], doc, x)]
+        if op == "$map":
+            return [_eval(arg["in"], doc, x) for x in ev(arg["input"])]
+        if op not in _EXPR_OPS:
+            raise NotImplementedError(f"aggregation operator {op} is not supported by MemoryCollection")
+        return _EXPR_OPS[op](arg, ev)
+    return {k: ev(v) for k, v in expr.items()}
+
+
+def _project_stage(doc, spec):
+    out = {"_id": doc.get("_id")} if spec.get("_id", 1) not in (0, False) else {}
+    for key, val in spec.items():
+        if key == "_id" and val in (0, False, 1, True):
+            continue
+        if val in (1, True):
+            if key in doc:
+                out[key] = doc[key]
+        else:
+            out[key] = _eval(val, doc)
+    return out
+
+
+def _group_stage(docs, spec):
+    groups: Dict[str, Dict[str, Any]] = {}
+    for doc in docs:
+        gid = _eval(spec["_id"], doc)
+        out = groups.setdefault(repr(gid), {"_id": gid})
+        for key, acc in spec.items():
+            if key == "_id":
+                continue
+            op, arg = next(iter(acc.items()))
+            if op != "$sum":
+                raise NotImplementedError(f"accumulator {op} is not supported by MemoryCollection")
+            out[key] = out.get(key, 0) + (_eval(arg, doc) or 0)
+    return list(groups.values())
+
+
+def _aggregate(docs: List[Dict[str, Any]], pipeline: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            docs = [d for d in docs if _matches(d, spec)]
+        elif name == "$project":
+            docs = [_project_stage(d, spec) for d in docs]
+        elif name == "$group":
+            docs = _group_stage(docs, spec)
+        elif name == "$sort":
+            for key, direction in reversed(list(spec.items())):
+                docs.sort(key=lambda d: (_get(d, key) is None, _get(d, key)), reverse=direction < 0)
+        else:
+            raise NotImplementedError(f"aggregation stage {name} is not supported by MemoryCollection")
+    return docs
+
+
+def _update_parts(op):
+    """(filter, update, upsert) of a pymongo UpdateOne.
+
+    pymongo has no public accessors for these; keep the attribute layout
+    in this one place and fail loudly if an upgrade changes it.
+    """
+    try:
+        return op._filter, op._doc, bool(op._upsert)
+    except AttributeError as e:
+        raise TypeError(f"MemoryCollection.bulk_write cannot read {type(op).__name__}") from e
+
+
+class _Cursor:
+    def __init__(self, docs: List[Dict[str, Any]]):
+        self._docs = docs
+
+    def sort(self, key, direction=1):
+        self._docs.sort(key=lambda d: (_get(d, key) is None, _get(d, key)), reverse=direction < 0)
+        return self
+
+    def limit(self, n):
+        if n:
+            self._docs = self._docs[:n]
+        return self
+
+    def batch_size(self, _):
+        return self
+
+    def __iter__(self):
+        return iter(self._docs)
+
+
+class MemoryCollection:
+    """Thread-safe in-memory subset of pymongo's Collection API."""
+
+    def __init__(self, name: str = "records", latency: Latency = None):
+        self.name = name
+        self.latency = latency or Latency()
+        self._docs: Dict[Any, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def create_index(self, *_, **__):
+        return "noop"
+
+    def insert_one(self, doc):
+        self.latency()
+        doc.setdefault("_id", ObjectId())
+        with self._lock:
+            self._docs[doc["_id"]] = copy.deepcopy(doc)
+        return SimpleNamespace(inserted_id=doc["_id"])
+
+    def find(self, flt=None, projection=None, **_):
+        self.latency()
+        with self._lock:
+            docs = [_project(d, projection) for d in self._docs.values() if _matches(d, flt)]
+        return _Cursor(docs)
+
+    def find_one(self, flt=None, projection=None, **_):
+        self.latency()
+        with self._lock:
+            for d in self._docs.values():
+                if _matches(d, flt):
+                    return _project(d, projection)
+        return None
+
+    def find_one_and_delete(self, flt, projection=None, **_):
+        self.latency()
+        with self._lock:
+            for key, d in list(self._docs.items()):
+                if _matches(d, flt):
+                    del self._docs[key]
+                    return _project(d, projection)
+        return None
+
+    def delete_one(self, flt):
+        self.latency()
+        with self._lock:
+            for key, d in list(self._docs.items()):
+                if _matches(d, flt):
+                    del self._docs[key]
+                    return SimpleNamespace(deleted_count=1)
+        return SimpleNamespace(deleted_count=0)
+
+    def delete_many(self, flt):
+        self.latency()
+        with self._lock:
+            keys = [k for k, d in self._docs.items() if _matches(d, flt)]
+            for k in keys:
+                del self._docs[k]
+        return SimpleNamespace(deleted_count=len(keys))
+
+    def replace_one(self, flt, doc, upsert=False):
+        self.latency()
+        with self._lock:
+            for key, d in list(self._docs.items()):
+                if _matches(d, flt):
+                    self._docs[key] = copy.deepcopy(dict(doc, _id=d["_id"]))
+                    return SimpleNamespace(matched_count=1)
+            if upsert:
+                doc = copy.deepcopy(doc)
+                doc.setdefault("_id", ObjectId())
+                self._docs[doc["_id"]] = doc
+        return SimpleNamespace(matched_count=0)
+
+    def _apply_update(self, flt, update, upsert):
+        # caller holds the lock
+        target = next((d for d in self._docs.values() if _matches(d, flt)), None)
+        if target is None:
+            if not upsert:
+                return
+            target = {k: v for k, v in flt.items() if not isinstance(v, dict)}
+            target.setdefault("_id", ObjectId())
+            self._docs[target["_id"]] = target
+        for op, fields in update.items():
+            for path, val in fields.items():
+                parts = path.split(".")
+                node = target
+                for p in parts[:-1]:
+                    node = node.setdefault(p, {})
+                if op == "$inc":
+                    node[parts[-1]] = node.get(parts[-1], 0) + val
+                elif op == "$set":
+                    node[parts[-1]] = copy.deepcopy(val)
+                elif op == "$unset":
+                    node.pop(parts[-1], None)
+
+    def update_one(self, flt, update, upsert=False):
+        self.latency()
+        with self._lock:
+            self._apply_update(flt, update, upsert)
+
+    def bulk_write(self, ops, ordered=True):
+        self.latency()  # one round trip for the whole batch
+        with self._lock:
+            for op in ops:
+                if not isinstance(op, UpdateOne):
+                    raise TypeError(f"MemoryCollection.bulk_write only supports UpdateOne, got {type(op).__name__}")
+                self._apply_update(*_update_parts(op))
+        return SimpleNamespace(acknowledged=True)
+
+    def aggregate(self, pipeline, **_):
+        """$match / $project / $group ($sum) / $sort, as used by the trend fallback ($merge unsupported)."""
+        self.latency()
+        with self._lock:
+            docs = copy.deepcopy(list(self._docs.values()))
+        return iter(_aggregate(docs, pipeline))
+
+    def count_documents(self, flt=None, limit=0, **_):
+        with self._lock:
+            n = sum(1 for d in self._docs.values() if _matches(d, flt))
+        return min(n, limit) if limit else n
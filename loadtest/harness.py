@@ -0,0 +1,206 @@
+import datetime, http.cookiejar, math, os, random, tempfile, threading, time, uuid
+import urllib.error, urllib.parse, urllib.request
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Tuple
+
+from .fakes import FakeStorage, Latency, MemoryCollection, make_fixture_image
+
+# ------------------------------------------------------------------
+# Load-test harness
+# ------------------------------------------------------------------
+# Boots the Flask app in-process on a threaded werkzeug server, swaps
+# the image storage backend and MongoDB for the local stand-ins in
+# fakes.py (or a local mongod via --mongo-uri), then drives a weighted mix of endpoints from
+# N concurrent clients and reports throughput and latency percentiles.
+# ------------------------------------------------------------------
+
+DEFAULT_MIX = {"upload": 1, "quiz": 4, "history": 4, "practice": 1, "trend": 1}
+
+
+def install(app_module, cloud_latency: Latency = None, db_latency: Latency = None,
+            mongo_uri: str = None, per_category: int = 200) -> FakeStorage:
+    """Point the already-imported app at local stand-ins."""
+    import cloud_quiz_search, image_storage, quiz_manifest
+
+    fake = FakeStorage(latency=cloud_latency, per_category=per_category)
+    image_storage.set_storage(fake)
+    app_module.storage = fake
+
+    # private manifest so the real one is never touched
+    quiz_manifest.MANIFEST_PATH = os.path.join(tempfile.mkdtemp(prefix="loadtest_"), "manifest.sqlite3")
+    quiz_manifest.sync(cloud_quiz_search._parse_roots(default_roots=["home", ""]),
+                       ["白苔", "黃苔", "灰黑苔", "紅紫舌無苔"], keep=cloud_quiz_search._is_displayable)
+
+    if mongo_uri:
+        from pymongo import MongoClient
+        db = MongoClient(mongo_uri).get_database("tongueDB_loadtest")
+        db.drop_collection("records")
+        db.drop_collection("record_rollups")
+        db.drop_collection("calibration_profiles")
+        app_module.records_collection = db.get_collection("records")
+        app_module.rollups_collection = db.get_collection("record_rollups")
+        app_module.calibration_collection = db.get_collection("calibration_profiles")
+    else:
+        app_module.records_collection = MemoryCollection("records", db_latency)
+        app_module.rollups_collection = MemoryCollection("record_rollups", db_latency)
+        app_module.calibration_collection = MemoryCollection("calibration_profiles", db_latency)
+    return fake
+
+
+def seed_records(app_module, patients: List[str], per_patient: int, image_bytes: bytes):
+    """Insert analysed records directly (no HTTP) so history reads have data."""
+    import diagnosis_codes
+    import history_trend
+    from color_analysis import analyze_image_color_array, decode_image_bytes
+    from color_analysis_overlay import analyze_tongue_regions_with_overlay_array
+
+    img = decode_image_bytes(image_bytes)
+    main_color, comment, advice, rgb = analyze_image_color_array(img)
+    regions = analyze_tongue_regions_with_overlay_array(img)
+    now = datetime.datetime.utcnow()
+    for pid in patients:
+        for i in range(per_patient):
+            record = {
+                "patient_id": pid,
+                "image_url": f"https://res.cloudinary.com/loadtest/image/upload/v1/tongue/{pid}/seed_{i}.jpg",
+                "public_id": f"tongue/{pid}/seed_{i}",
+                "main_color": main_color, "comment": comment, "advice": advice,
+                "rgb": rgb, **diagnosis_codes.compact_fields(regions),
+                "timestamp": now - datetime.timedelta(days=i),
+            }
+            app_module.records_collection.insert_one(record)
+            history_trend.apply_rollup(app_module.rollups_collection, record,
+                                       records=app_module.records_collection)
+
+
+def _multipart(fields: Dict[str, str], files: Dict[str, Tuple[str, bytes, str]]):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data, ctype) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: {ctype}\r\n\r\n'.encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def _requests(base: str, patients: List[str], image_bytes: bytes) -> Dict[str, Callable]:
+    """endpoint name -> fn(opener) returning the HTTP status."""
+
+    def _send(opener, req):
+        try:
+            with opener.open(req, timeout=60) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def upload(opener):
+        patient = random.choice(patients)
+        body, ctype = _multipart({"patient_id": patient}, {"image": ("tongue.jpg", image_bytes, "image/jpeg")})
+        url = f"{base}/upload?patient={urllib.parse.quote(patient)}"  # 與前端相同，排隊以病患區分
+        return _send(opener, urllib.request.Request(url, body, {"Content-Type": ctype}))
+
+    practice_sessions = set()
+
+    def practice(opener):
+        if id(opener) not in practice_sessions:
+            # 與瀏覽器相同：先開練習頁取得 session，上傳才會以使用者區分排隊
+            _send(opener, urllib.request.Request(f"{base}/practice/"))
+            practice_sessions.add(id(opener))
+        body, ctype = _multipart({"user_answers": "{}"}, {"image": ("tongue.jpg", image_bytes, "image/jpeg")})
+        return _send(opener, urllib.request.Request(f"{base}/practice/upload", body, {"Content-Type": ctype}))
+
+    def quiz(opener):
+        return _send(opener, urllib.request.Request(f"{base}/quiz"))
+
+    def history(opener):
+        pid = urllib.parse.quote(random.choice(patients))
+        return _send(opener, urllib.request.Request(f"{base}/history_data?patient={pid}"))
+
+    def trend(opener):
+        pid = urllib.parse.quote(random.choice(patients))
+        return _send(opener, urllib.request.Request(f"{base}/history_trend?patient={pid}&unit=week"))
+
+    return {"upload": upload, "practice": practice, "quiz": quiz, "history": history, "trend": trend}
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # nearest-rank
+    k = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def run(base: str, mix: Dict[str, float], concurrency: int, duration: float,
+        patients: List[str], image_bytes: bytes, warmup: float = 0.0) -> Dict[str, Any]:
+    calls = _requests(base, patients, image_bytes)
+    names = [n for n, w in mix.items() if w > 0 and n in calls]
+    weights = [mix[n] for n in names]
+    samples: Dict[str, List[float]] = defaultdict(list)
+    statuses: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+    lock = threading.Lock()
+    start = time.time()
+    measure_from = start + warmup
+    stop = measure_from + duration
+
+    def worker():
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        while True:
+            t0 = time.time()
+            if t0 >= stop:
+                return
+            name = random.choices(names, weights)[0]
+            try:
+                status = calls[name](opener)
+            except Exception:
+                status = 0  # connection error / timeout
+            t1 = time.time()
+            if t0 >= measure_from:
+                with lock:
+                    samples[name].append((t1 - t0) * 1000.0)
+                    statuses[name][status] += 1
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    elapsed = max(1e-9, min(time.time(), stop) - measure_from)
+    report = {"duration_s": round(elapsed, 2), "concurrency": concurrency, "endpoints": {}}
+    for name in names:
+        lat = sorted(samples[name])
+        ok = sum(n for code, n in statuses[name].items() if 200 <= code < 400)
+        report["endpoints"][name] = {
+            "requests": len(lat),
+            "ok": ok,
+            "errors": len(lat) - ok,
+            "status": {str(k): v for k, v in sorted(statuses[name].items())},
+            "rps": round(len(lat) / elapsed, 2),
+            "p50_ms": round(_percentile(lat, 50), 1),
+            "p95_ms": round(_percentile(lat, 95), 1),
+            "p99_ms": round(_percentile(lat, 99), 1),
+            "max_ms": round(lat[-1], 1) if lat else 0.0,
+        }
+    return report
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    lines = [f"duration {report['duration_s']}s, concurrency {report['concurrency']}",
+             f"{'endpoint':<10}{'reqs':>7}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"]
+    for name, r in report["endpoints"].items():
+        lines.append(f"{name:<10}{r['requests']:>7}{r['errors']:>6}{r['rps']:>9.1f}"
+                     f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['max_ms']:>9.1f}")
+    return "\n".join(lines)
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in (text or "").split(","):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            mix[k.strip()] = float(v)
+    return mix or dict(DEFAULT_MIX)
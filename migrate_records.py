@@ -0,0 +1,86 @@
+from typing import Any, Dict
+
+import bson
+from pymongo import UpdateOne
+
+import diagnosis_codes
+
+# ------------------------------------------------------------------
+# Bulk rewrite of legacy records to coded diagnoses
+# ------------------------------------------------------------------
+# Replaces the embedded five_regions text of old `records` documents with
+# region_codes + ruleset_v (see diagnosis_codes).  Documents are read in
+# _id order with a narrow projection and rewritten with unordered
+# bulk_write batches, so the run is restartable: migrated documents no
+# longer match the filter.
+#
+# A document is left untouched when it cannot be coded losslessly: an
+# unknown region / diagnosis name (e.g. the old 心/肝/脾/肺 grid) or
+# theory / advice text that differs from the current ruleset.
+#
+# Rollups count (區域, 診斷) pairs, which the rewrite preserves, so
+# record_rollups need no rebuild.  MongoDB reuses the freed space for new
+# writes; run `compact` on the collection to return it to the OS.
+#
+#   python migrate_records.py [--dry-run] [--batch N] [--limit N]
+# ------------------------------------------------------------------
+
+
+def _lossless(five_regions, codes) -> bool:
+    decoded = diagnosis_codes.decode_regions(codes)
+    return all(r.get("理論", d["理論"]) == d["理論"] and r.get("建議", d["建議"]) == d["建議"]
+               for r, d in zip(five_regions, decoded))
+
+
+def migrate(records, batch: int = 1000, limit: int = 0, dry_run: bool = False) -> Dict[str, Any]:
+    """Rewrite legacy documents; returns counts and the five_regions bytes saved."""
+    stats = {"scanned": 0, "migrated": 0, "skipped": 0, "bytes_before": 0, "bytes_after": 0}
+    ops = []
+
+    def flush():
+        if ops and not dry_run:
+            records.bulk_write(ops, ordered=False)
+        ops.clear()
+
+    cursor = records.find({"five_regions": {"$exists": True}, "region_codes": {"$exists": False}},
+                          {"five_regions": 1}).sort("_id", 1).batch_size(batch)
+    if limit:
+        cursor = cursor.limit(limit)
+    for doc in cursor:
+        stats["scanned"] += 1
+        regions = doc.get("five_regions") or []
+        if isinstance(regions, dict):
+            regions = list(regions.values())
+        codes = diagnosis_codes.encode_regions(regions)
+        if codes is None or not _lossless(regions, codes):
+            stats["skipped"] += 1
+            continue
+        new_fields = {"region_codes": codes, "ruleset_v": diagnosis_codes.RULESET_VERSION}
+        stats["bytes_before"] += len(bson.encode({"five_regions": regions}))
+        stats["bytes_after"] += len(bson.encode(new_fields))
+        ops.append(UpdateOne({"_id": doc["_id"], "five_regions": {"$exists": True}},
+                             {"$set": new_fields, "$unset": {"five_regions": ""}}))
+        stats["migrated"] += 1
+        if len(ops) >= batch:
+            flush()
+    flush()
+    return stats
+
+
+if __name__ == "__main__":
+    import os, sys
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    def _arg(name, default):
+        return int(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
+
+    load_dotenv()
+    records = MongoClient(os.environ["MONGO_URI"]).get_database("tongueDB").get_collection("records")
+    dry_run = "--dry-run" in sys.argv
+    s = migrate(records, batch=_arg("--batch", 1000), limit=_arg("--limit", 0), dry_run=dry_run)
+    saved = s["bytes_before"] - s["bytes_after"]
+    print(f"{'（試跑）' if dry_run else ''}掃描 {s['scanned']} 筆，轉換 {s['migrated']} 筆，略過 {s['skipped']} 筆")
+    if s["migrated"]:
+        print(f"五區欄位 {s['bytes_before']} → {s['bytes_after']} bytes"
+              f"（省 {saved} bytes，約 {s['bytes_before'] / max(1, s['bytes_after']):.1f} 倍）")
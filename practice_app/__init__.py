@@ -1,5 +1,7 @@
-from flask import Blueprint, render_template, request, jsonify
+import uuid
+from flask import Blueprint, render_template, request, jsonify, session
 from .practice_analysis import run_practice_analysis  # 你的新專案分析入口
+import admission
 
 practice_bp = Blueprint(
     "practice",
@@ -10,13 +12,22 @@ practice_bp = Blueprint(
 
 @practice_bp.get("/")
 def practice_index():
+    session.setdefault("practice_uid", uuid.uuid4().hex)
     return render_template("practice/index.html")
 
+def _practice_client():
+    """公平排隊以瀏覽器 session 區分（同一間學校共用 NAT 的學生各自計算名額）；沒有 session 才用來源位址。"""
+    uid = session.get("practice_uid")
+    return f"practice:{uid}" if uid else admission.client_address()
+
 @practice_bp.post("/upload")
+@admission.analysis.guard(_practice_client)  # 與主專案 /upload 共用分析名額
 def practice_upload():
     image = request.files.get("image")
     user_answers = request.form.get("user_answers")
     result = run_practice_analysis(image, user_answers)
+    if result.get("error"):
+        return jsonify({"error": result["error"]}), result.get("status", 400)
 
     # 若新專案回傳格式不同，這裡轉成主專案慣用的形狀
     return jsonify({
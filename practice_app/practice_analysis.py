@@ -1,24 +1,40 @@
-import os, uuid, json
+import json
 from werkzeug.datastructures import FileStorage
 
 # 重用主專案的分析模組（保持一致）
-from color_analysis import analyze_image_color, analyze_tongue_regions
-
-UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+from color_analysis import decode_image_bytes, analyze_image_array
+import analysis_budget
+from . import practice_spool
 
 def run_practice_analysis(image_file: FileStorage, user_answers_json: str | None):
     if not image_file:
         return {"error": "No image uploaded"}
 
-    # 儲存上傳圖片（與主專案一致的行為）
-    filename = f"practice_{uuid.uuid4().hex}.jpg"
-    path = os.path.join(UPLOAD_DIR, filename)
-    image_file.save(path)
+    # 全程在記憶體內處理：讀一次、解碼一次（不寫入 uploads/）
+    image_bytes = image_file.read()
+    meter = analysis_budget.MemoryMeter()
+    with meter.stage("decode"):
+        if analysis_budget.BUDGET_BYTES:
+            try:
+                img, _ = analysis_budget.decode_within_budget(image_bytes)
+            except analysis_budget.OverBudget as e:
+                return {"error": f"影像過大，無法分析（{e}）", "status": 413}
+        else:
+            img = decode_image_bytes(image_bytes)
+    if img is None:
+        return {"error": "Invalid image"}
+
+    # 僅在明確啟用保留（PRACTICE_SPOOL_DIR）時寫入有上限的暫存目錄
+    practice_spool.retain(image_bytes)
 
-    # 主色 + 五區分析（沿用主專案邏輯）
-    main_color, _, _, avg_lab = analyze_image_color(path)
-    regions = analyze_tongue_regions(path)
+    # 主色 + 五區分析（沿用主專案邏輯，共用同一次 LAB 轉換；有記憶體預算時分條累加）
+    if analysis_budget.BUDGET_BYTES:
+        main_color, _, _, avg_lab, regions = analysis_budget.analyze_grid_striped(img, meter=meter)
+    else:
+        with meter.stage("regions"):
+            main_color, _, _, avg_lab, regions = analyze_image_array(img)
+    if analysis_budget.TRACE:
+        print(f"🧮 練習分析記憶體：{meter.summary()}")
 
     # 解析使用者觀察
     try:
@@ -0,0 +1,98 @@
+import os, time, uuid, threading
+
+# ------------------------------------------------------------------
+# Optional retention of practice uploads
+# ------------------------------------------------------------------
+# Practice analysis runs fully in memory; images are only written to disk
+# when PRACTICE_SPOOL_DIR is set.  The spool is capped by total size and
+# by file age, and a background thread trims it so the container disk
+# can never fill up.
+#
+# Envs:
+#   PRACTICE_SPOOL_DIR        enable retention into this directory
+#   PRACTICE_SPOOL_MAX_MB     total size cap (default 200)
+#   PRACTICE_SPOOL_MAX_AGE    max file age in seconds (default 7 days)
+#   PRACTICE_SPOOL_SWEEP      cleanup interval in seconds (default 300)
+# ------------------------------------------------------------------
+
+SPOOL_DIR = os.environ.get("PRACTICE_SPOOL_DIR", "").strip()
+MAX_BYTES = int(float(os.environ.get("PRACTICE_SPOOL_MAX_MB", "200")) * 1024 * 1024)
+MAX_AGE = int(os.environ.get("PRACTICE_SPOOL_MAX_AGE", str(7 * 24 * 3600)))
+SWEEP_SECONDS = int(os.environ.get("PRACTICE_SPOOL_SWEEP", "300"))
+
+_wake = threading.Event()
+_started = False
+_start_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return bool(SPOOL_DIR)
+
+
+def cleanup(spool_dir: str = None, max_bytes: int = None, max_age: int = None) -> int:
+    """Delete expired files, then oldest files until under the size cap.
+
+    Returns the number of files removed.
+    """
+    spool_dir = spool_dir or SPOOL_DIR
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    max_age = MAX_AGE if max_age is None else max_age
+    if not spool_dir or not os.path.isdir(spool_dir):
+        return 0
+
+    now = time.time()
+    files = []
+    for entry in os.scandir(spool_dir):
+        if entry.is_file():
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, entry.path))
+    files.sort()  # oldest first
+
+    removed = 0
+    total = sum(size for _, size, _ in files)
+    for mtime, size, path in files:
+        if now - mtime < max_age and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    return removed
+
+
+def _sweeper():
+    while True:
+        _wake.wait(SWEEP_SECONDS)
+        _wake.clear()
+        try:
+            cleanup()
+        except Exception:
+            pass
+
+
+def _ensure_sweeper():
+    global _started
+    if _started:
+        return
+    with _start_lock:
+        if not _started:
+            threading.Thread(target=_sweeper, name="practice-spool-sweeper", daemon=True).start()
+            _started = True
+
+
+def retain(image_bytes: bytes, suffix: str = ".jpg"):
+    """Write an upload into the spool if retention is enabled; return its path."""
+    if not enabled() or not image_bytes:
+        return None
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    path = os.path.join(SPOOL_DIR, f"practice_{uuid.uuid4().hex}{suffix}")
+    with open(path, "wb") as f:
+        f.write(image_bytes)
+    _ensure_sweeper()
+    _wake.set()  # trim right away instead of waiting for the next sweep
+    return path
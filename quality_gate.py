@@ -0,0 +1,89 @@
+import os
+from typing import Any, Dict
+
+import cv2
+import numpy as np
+
+from color_analysis import extract_tongue_mask, fit_max_side
+
+# ------------------------------------------------------------------
+# Pre-analysis image-quality gate
+# ------------------------------------------------------------------
+# Runs on a small copy of the photo (QUALITY_MAX_SIDE px) before anything
+# expensive happens (storage upload, full analysis, Mongo insert):
+#
+#   sharpness  variance of the Laplacian of the grey image
+#   exposure   mean brightness plus the share of crushed (<16) and
+#              blown (>=250) pixels in the grey histogram
+#   coverage   share of the frame covered by extract_tongue_mask()
+#
+# assess() returns the measurements, a 0..1 score and the Chinese reasons
+# for rejection; is_better() ranks the frames of a burst.  Frames must be
+# assessed without the capture guide drawn in (its sharp edges pass the
+# sharpness check and its red pixels count as tongue coverage).
+#
+# Envs (thresholds are for the QUALITY_MAX_SIDE copy):
+#   QUALITY_GATE            0 disables rejection (default 1)
+#   QUALITY_MAX_SIDE        size of the assessed copy (default 256)
+#   QUALITY_MIN_SHARPNESS   Laplacian variance (default 20)
+#   QUALITY_MIN_BRIGHTNESS / QUALITY_MAX_BRIGHTNESS  mean grey (40 / 225)
+#   QUALITY_MAX_CLIPPED     crushed or blown pixel share (default 0.4)
+#   QUALITY_MIN_COVERAGE    tongue-mask share (default 0.05)
+#   QUALITY_BURST           frames the capture page sends per photo (default 1;
+#                           each extra frame adds a full upload)
+# ------------------------------------------------------------------
+
+ENABLED = os.environ.get("QUALITY_GATE", "1") != "0"
+MAX_SIDE = int(os.environ.get("QUALITY_MAX_SIDE", "256"))
+MIN_SHARPNESS = float(os.environ.get("QUALITY_MIN_SHARPNESS", "20"))
+MIN_BRIGHTNESS = float(os.environ.get("QUALITY_MIN_BRIGHTNESS", "40"))
+MAX_BRIGHTNESS = float(os.environ.get("QUALITY_MAX_BRIGHTNESS", "225"))
+MAX_CLIPPED = float(os.environ.get("QUALITY_MAX_CLIPPED", "0.4"))
+MIN_COVERAGE = float(os.environ.get("QUALITY_MIN_COVERAGE", "0.05"))
+BURST = max(1, int(os.environ.get("QUALITY_BURST", "1")))
+
+
+def assess(img: np.ndarray) -> Dict[str, Any]:
+    """Measure sharpness / exposure / tongue coverage of a BGR image."""
+    small = fit_max_side(img, MAX_SIDE)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_32F).var())
+
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    total = max(1.0, float(hist.sum()))
+    brightness = float(np.dot(hist, np.arange(256)) / total)
+    dark = float(hist[:16].sum() / total)
+    blown = float(hist[250:].sum() / total)
+
+    coverage = cv2.countNonZero(extract_tongue_mask(small)) / float(gray.size)
+
+    reasons = []
+    if sharpness < MIN_SHARPNESS:
+        reasons.append("影像模糊，請保持手機穩定後重拍")
+    if brightness < MIN_BRIGHTNESS or dark > MAX_CLIPPED:
+        reasons.append("光線不足，請到明亮處重拍")
+    elif brightness > MAX_BRIGHTNESS or blown > MAX_CLIPPED:
+        reasons.append("曝光過度，請避免強光直射")
+    if coverage < MIN_COVERAGE:
+        reasons.append("未偵測到舌頭，請對準疊圖範圍")
+
+    # each factor saturates at twice its threshold; exposure falls off with clipping
+    score = (min(1.0, sharpness / (2 * MIN_SHARPNESS)) if MIN_SHARPNESS else 1.0) \
+        * (min(1.0, coverage / (2 * MIN_COVERAGE)) if MIN_COVERAGE else 1.0) \
+        * max(0.0, 1.0 - max(dark, blown))
+    return {
+        "ok": not reasons,
+        "score": round(score, 3),
+        "sharpness": round(sharpness, 1),
+        "brightness": round(brightness, 1),
+        "dark": round(dark, 3),
+        "blown": round(blown, 3),
+        "coverage": round(coverage, 3),
+        "reasons": reasons,
+    }
+
+
+def is_better(report: Dict[str, Any], than: Dict[str, Any]) -> bool:
+    """Passing frames beat failing ones, then the higher score wins."""
+    return (report["ok"], report["score"]) > (than["ok"], than["score"])
+
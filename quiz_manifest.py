@@ -0,0 +1,251 @@
+import os, random, sqlite3, threading, time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Any
+import image_storage
+
+# ------------------------------------------------------------------
+# Local manifest of quiz images
+# ------------------------------------------------------------------
+# Cloudinary listing calls are capped (100-500 resources per call), so
+# sampling straight from the API only ever sees the first page of a
+# folder.  Instead we keep a small SQLite file with EVERY image per
+# (root, category), listed through the storage backend (full cursor
+# pagination on Cloudinary) and refreshed incrementally by created_at in
+# a background thread.
+#
+# Each folder's images get a dense sequence number 0..count-1, so a
+# uniform random pick is a single primary-key lookup and /quiz never
+# touches the network.  Every thread keeps one open connection (WAL lets
+# readers run during a sync) and the schema is created once per file.
+#
+# Envs:
+#   QUIZ_MANIFEST_PATH            sqlite file (default "quiz_manifest.sqlite3")
+#   QUIZ_MANIFEST_SYNC_SECONDS    incremental refresh interval (default 600)
+#   QUIZ_MANIFEST_REBUILD_SECONDS full rebuild interval, drops deleted
+#                                 images (default 86400)
+# ------------------------------------------------------------------
+
+MANIFEST_PATH = os.environ.get("QUIZ_MANIFEST_PATH", "quiz_manifest.sqlite3")
+SYNC_SECONDS = int(os.environ.get("QUIZ_MANIFEST_SYNC_SECONDS", "600"))
+REBUILD_SECONDS = int(os.environ.get("QUIZ_MANIFEST_REBUILD_SECONDS", "86400"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    root          TEXT NOT NULL,
+    category      TEXT NOT NULL,
+    seq           INTEGER NOT NULL,
+    public_id     TEXT NOT NULL,
+    resource_type TEXT,
+    type          TEXT,
+    format        TEXT,
+    secure_url    TEXT,
+    created_at    TEXT,
+    PRIMARY KEY (root, category, seq),
+    UNIQUE (root, category, public_id)
+);
+CREATE TABLE IF NOT EXISTS folders (
+    root            TEXT NOT NULL,
+    category        TEXT NOT NULL,
+    count           INTEGER NOT NULL DEFAULT 0,
+    last_created_at TEXT,
+    synced_at       REAL,
+    rebuilt_at      REAL,
+    PRIMARY KEY (root, category)
+);
+"""
+
+_sync_lock = threading.Lock()
+_schema_lock = threading.Lock()
+_initialised = set()      # manifest paths whose schema exists
+_local = threading.local()
+
+
+def _connect(path: str = None) -> sqlite3.Connection:
+    """This thread's connection to the manifest (opened once, schema created once per file)."""
+    path = path or MANIFEST_PATH
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        with _schema_lock:
+            if path not in _initialised:
+                conn.execute("PRAGMA journal_mode=WAL")  # persisted in the file
+                conn.executescript(_SCHEMA)
+                _initialised.add(path)
+        conns[path] = conn
+    return conn
+
+
+def _folder_for(cat: str, root: str) -> str:
+    root = (root or "").strip().strip("/")
+    return f"{cat}" if root == "" else f"{root}/{cat}"
+
+
+def sync_folder(root: str, cat: str, full: bool = False,
+                keep: Callable[[Dict[str, Any]], bool] = None, path: str = None) -> int:
+    """Pull new images of one folder into the manifest; return how many were added.
+
+    With full=True the folder is re-listed from scratch (to forget images
+    deleted in Cloudinary); readers keep seeing the old rows until commit.
+    """
+    conn = _connect(path)
+    row = conn.execute(
+        "SELECT last_created_at FROM folders WHERE root=? AND category=?", (root, cat)
+    ).fetchone()
+    since = None if (full or row is None) else row["last_created_at"]
+
+    # List first (network), then write in one short transaction.
+    pages = list(image_storage.get_storage().list_prefix(_folder_for(cat, root), since))
+    if keep is not None:
+        pages = [r for r in pages if keep(r)]
+
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if full:
+            conn.execute("DELETE FROM images WHERE root=? AND category=?", (root, cat))
+            count = 0
+        else:
+            cur = conn.execute(
+                "SELECT count FROM folders WHERE root=? AND category=?", (root, cat)
+            ).fetchone()
+            count = cur["count"] if cur else 0
+        start = count
+        last = since
+        for r in pages:
+            added = conn.execute(
+                "INSERT OR IGNORE INTO images (root, category, seq, public_id, resource_type,"
+                " type, format, secure_url, created_at) VALUES (?,?,?,?,?,?,?,?,?)",
+                (root, cat, count, r.get("public_id", ""),
+                 (r.get("resource_type") or "image").lower(),
+                 (r.get("type") or "upload").lower(),
+                 (r.get("format") or "").lower(),
+                 r.get("secure_url") or r.get("url", ""),
+                 r.get("created_at") or ""),
+            ).rowcount
+            count += added
+            if r.get("created_at") and (last is None or r["created_at"] > last):
+                last = r["created_at"]
+        conn.execute(
+            "INSERT INTO folders (root, category, count, last_created_at, synced_at, rebuilt_at)"
+            " VALUES (?,?,?,?,?,?)"
+            " ON CONFLICT(root, category) DO UPDATE SET count=excluded.count,"
+            " last_created_at=excluded.last_created_at, synced_at=excluded.synced_at,"
+            " rebuilt_at=COALESCE(excluded.rebuilt_at, folders.rebuilt_at)",
+            (root, cat, count, last, now, now if (full or row is None) else None),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return count - start
+
+
+def sync(roots: Iterable[str], categories: Iterable[str],
+         keep: Callable[[Dict[str, Any]], bool] = None, full: bool = False, path: str = None):
+    """Sync every (root, category) folder; folders that fail are skipped."""
+    now = time.time()
+    state = {(r["root"], r["category"]): r for r in _connect(path).execute("SELECT * FROM folders")}
+    for root in roots:
+        for cat in categories:
+            st = state.get((root, cat))
+            need_full = full or st is None or (now - (st["rebuilt_at"] or 0)) >= REBUILD_SECONDS
+            try:
+                sync_folder(root, cat, full=need_full, keep=keep, path=path)
+            except Exception:
+                # ignore root that doesn't exist or lacks permission
+                continue
+
+
+def _is_stale(roots, categories, path: str = None) -> bool:
+    synced = {(r["root"], r["category"]): r["synced_at"] or 0
+              for r in _connect(path).execute("SELECT root, category, synced_at FROM folders")}
+    now = time.time()
+    return any(now - synced.get((root, cat), 0) >= SYNC_SECONDS
+               for root in roots for cat in categories)
+
+
+def ensure_fresh(roots: List[str], categories: List[str],
+                 keep: Callable[[Dict[str, Any]], bool] = None, path: str = None) -> bool:
+    """Start a background sync if the manifest is stale; never blocks.
+
+    Returns True when a sync thread was started.
+    """
+    if not _is_stale(roots, categories, path):
+        return False
+    if not _sync_lock.acquire(blocking=False):
+        return False  # a sync is already running in this process
+
+    def _run():
+        try:
+            sync(roots, categories, keep=keep, path=path)
+        finally:
+            _sync_lock.release()
+
+    threading.Thread(target=_run, name="quiz-manifest-sync", daemon=True).start()
+    return True
+
+
+def pick(roots: List[str], categories: List[str],
+         path: str = None) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """Uniformly pick (category, resource) from the manifest, or None if empty.
+
+    Category is uniform over non-empty categories (as the live Search path
+    did); within a category every image is equally likely across roots.
+    """
+    conn = _connect(path)
+    counts: Dict[str, List[Tuple[str, int]]] = {}
+    for r in conn.execute("SELECT root, category, count FROM folders WHERE count > 0"):
+        if r["root"] in roots and r["category"] in categories:
+            counts.setdefault(r["category"], []).append((r["root"], r["count"]))
+    if not counts:
+        return None
+
+    cat = random.choice(list(counts))
+    total = sum(n for _, n in counts[cat])
+    i = random.randrange(total)
+    for root, n in counts[cat]:
+        if i < n:
+            break
+        i -= n
+    row = conn.execute(
+        "SELECT * FROM images WHERE root=? AND category=? AND seq=?", (root, cat, i)
+    ).fetchone()
+    if row is None:
+        return None
+    return cat, {
+        "public_id": row["public_id"],
+        "resource_type": row["resource_type"],
+        "type": row["type"],
+        "format": row["format"],
+        "secure_url": row["secure_url"],
+        "created_at": row["created_at"],
+    }
+
+
+def stats(path: str = None) -> Dict[str, Any]:
+    return {_folder_for(r["category"], r["root"]): {
+                "count": r["count"],
+                "last_created_at": r["last_created_at"],
+                "synced_at": r["synced_at"],
+            } for r in _connect(path).execute("SELECT * FROM folders")}
+
+
+if __name__ == "__main__":
+    # 手動重建：python quiz_manifest.py [--full]
+    import sys, json
+    from dotenv import load_dotenv
+    import cloudinary
+    from cloud_quiz_search import _parse_roots, _is_displayable
+
+    load_dotenv()
+    cloudinary.config(
+        cloud_name=os.environ.get("CLOUD_NAME"),
+        api_key=os.environ.get("CLOUD_API_KEY"),
+        api_secret=os.environ.get("CLOUD_API_SECRET")
+    )
+    sync(_parse_roots(default_roots=["home", ""]), ["白苔", "黃苔", "灰黑苔", "紅紫舌無苔"],
+         keep=_is_displayable, full="--full" in sys.argv)
+    print(json.dumps(stats(), ensure_ascii=False, indent=2))
@@ -0,0 +1,145 @@
+import datetime, threading, time, uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+# ------------------------------------------------------------------
+# Server-side quiz state
+# ------------------------------------------------------------------
+# The cookie session only carries a question id ("practice_qid") and a
+# small per-browser id ("quiz_uid"); the question itself (URL, choices,
+# explanation) lives in QuizSessionStore.  With several gunicorn workers
+# a Mongo collection can back the store so any worker can check an
+# answer.
+#
+# QuizPrefetcher keeps a short queue of ready-made questions per user,
+# refilled by a thread pool while the user is answering, so /quiz
+# normally just pops from the queue.  Queued questions older than max_age
+# are dropped (their signed URL may be expiring, the asset may be gone).
+# ------------------------------------------------------------------
+
+
+class QuizSessionStore:
+    def __init__(self, ttl: int = 3600, maxsize: int = 10000, collection=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.collection = collection  # optional Mongo backing
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()  # qid -> (expires, question)
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        if self.collection is not None:
+            self.collection.create_index("created_at", expireAfterSeconds=self.ttl)
+
+    def put(self, qid: str, question: Dict[str, Any]):
+        with self._lock:
+            self._items[qid] = (time.time() + self.ttl, question)
+            self._items.move_to_end(qid)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        if self.collection is not None:
+            try:
+                self.collection.replace_one(
+                    {"_id": qid},
+                    {"_id": qid, "question": question, "created_at": datetime.datetime.utcnow()},
+                    upsert=True,
+                )
+            except Exception as e:
+                print(f"⚠️ 題目暫存寫入失敗：{e}")
+
+    def pop(self, qid: str) -> Optional[Dict[str, Any]]:
+        """Return and forget a question (each question is answered once)."""
+        with self._lock:
+            hit = self._items.pop(qid, None)
+        if hit is not None and hit[0] >= time.time():
+            if self.collection is not None:
+                try:
+                    self.collection.delete_one({"_id": qid})
+                except Exception:
+                    pass
+            return hit[1]
+        if self.collection is not None:
+            try:
+                doc = self.collection.find_one_and_delete({"_id": qid})
+            except Exception:
+                doc = None
+            if doc:
+                return doc.get("question")
+        return None
+
+
+class QuizPrefetcher:
+    def __init__(self, generate: Callable[[], Dict[str, Any]], depth: int = 2,
+                 workers: int = 2, max_users: int = 5000, max_age: float = 600):
+        self.generate = generate
+        self.depth = depth
+        self.max_users = max_users
+        self.max_age = max_age
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()  # uid -> deque of (created, question)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="quiz-prefetch")
+
+    def _new_question(self) -> Dict[str, Any]:
+        q = dict(self.generate())
+        q["qid"] = uuid.uuid4().hex
+        return q
+
+    def _queue(self, uid: str) -> deque:
+        # caller holds the lock
+        q = self._queues.get(uid)
+        if q is None:
+            q = self._queues[uid] = deque()
+            while len(self._queues) > self.max_users:
+                self._queues.popitem(last=False)
+        self._queues.move_to_end(uid)
+        return q
+
+    def _refill(self, uid: str):
+        try:
+            while True:
+                with self._lock:
+                    if len(self._queue(uid)) >= self.depth:
+                        return
+                q = self._new_question()
+                with self._lock:
+                    self._queue(uid).append((time.time(), q))
+        except Exception as e:
+            print(f"⚠️ 預先出題失敗：{e}")
+        finally:
+            with self._lock:
+                self._pending.discard(uid)
+
+    def schedule(self, uid: str):
+        with self._lock:
+            if uid in self._pending:
+                return
+            self._pending.add(uid)
+        self._pool.submit(self._refill, uid)
+
+    def _drop_stale(self, queue: deque):
+        # caller holds the lock
+        oldest = time.time() - self.max_age
+        while queue and queue[0][0] < oldest:
+            queue.popleft()
+
+    def next(self, uid: str) -> Dict[str, Any]:
+        """Next question for this user; generated inline only if the queue is empty."""
+        with self._lock:
+            queue = self._queue(uid)
+            self._drop_stale(queue)
+            q = queue.popleft()[1] if queue else None
+        if q is None:
+            q = self._new_question()
+        self.schedule(uid)
+        return q
+
+    def peek(self, uid: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            queue = self._queues.get(uid)
+            if queue:
+                self._drop_stale(queue)
+            q = queue[0][1] if queue else None
+        if q is None and queue is not None:
+            self.schedule(uid)
+        return q
@@ -0,0 +1,262 @@
+import csv, datetime, io, itertools, json, os
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from bson import ObjectId
+
+from diagnosis_codes import REGIONS, region_pairs
+
+try:  # Parquet is optional (pip install pyarrow)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# ------------------------------------------------------------------
+# Streaming export of `records`
+# ------------------------------------------------------------------
+# Records of one patient, a date range or the whole collection are read
+# through one server-side cursor (EXPORT_BATCH_SIZE documents per
+# getMore, _id order so no in-memory sort) and encoded batch by batch
+# into a generator of byte chunks.  Memory stays at roughly one batch no
+# matter how large the export is; /export hands the generator to Flask
+# as a streamed response and the CLI writes it to a file.
+#
+# Patient exports walk the (patient_id, _id) index created by
+# ensure_indexes() at app startup, so they read only that patient's
+# records in cursor order instead of scanning the collection.
+#
+# Formats:
+#   ndjson   one JSON document per line (ids / dates as strings)
+#   csv      flat columns (FIELDS), UTF-8 with BOM for Excel
+#   parquet  same columns, one row group per batch (needs pyarrow)
+#
+# Envs:
+#   EXPORT_BATCH_SIZE  cursor batch / rows per chunk (default 1000)
+#   EXPORT_TOKEN       shared secret for /export (unset = endpoint disabled)
+# ------------------------------------------------------------------
+
+BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "1000"))
+TOKEN = os.environ.get("EXPORT_TOKEN", "")
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+FIELDS = (["id", "patient_id", "timestamp", "image_url", "main_color", "L", "A", "B"]
+          + REGIONS + ["ruleset_v", "device_id", "calibration_v"])
+
+# 只有內部用途的欄位不匯出
+_PROJECTION = {"variant_public_ids": 0}
+_REGION_SET = set(REGIONS)
+
+
+def ensure_indexes(records):
+    records.create_index([("patient_id", 1), ("_id", 1)])
+
+
+def available_formats() -> List[str]:
+    return [f for f in FORMATS if f != "parquet" or pq is not None]
+
+
+def export_filter(patient_id: Optional[str] = None, start: Optional[datetime.datetime] = None,
+                  end: Optional[datetime.datetime] = None) -> Dict[str, Any]:
+    flt: Dict[str, Any] = {}
+    if patient_id:
+        flt["patient_id"] = patient_id
+    if start or end:
+        flt["timestamp"] = {}
+        if start:
+            flt["timestamp"]["$gte"] = start
+        if end:
+            flt["timestamp"]["$lt"] = end
+    return flt
+
+
+def iter_records(collection, flt: Dict[str, Any], batch_size: int = BATCH_SIZE) -> Iterator[Dict[str, Any]]:
+    cursor = collection.find(flt, _PROJECTION).sort("_id", 1).batch_size(batch_size)
+    try:
+        yield from cursor
+    finally:
+        close = getattr(cursor, "close", None)
+        if close:
+            close()  # stops the server-side cursor when the client goes away
+
+
+def _batches(docs: Iterable[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _jsonable(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+def flat_row(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """One record as FIELDS (LAB from `rgb`, one diagnosis column per region)."""
+    lab = doc.get("rgb") or []
+    calibration = doc.get("calibration") or {}
+    row = {
+        "id": str(doc.get("_id", "")),
+        "patient_id": doc.get("patient_id"),
+        "timestamp": doc.get("timestamp"),
+        "image_url": doc.get("image_url"),
+        "main_color": doc.get("main_color"),
+        "L": lab[0] if len(lab) == 3 else None,
+        "A": lab[1] if len(lab) == 3 else None,
+        "B": lab[2] if len(lab) == 3 else None,
+        "ruleset_v": doc.get("ruleset_v"),
+        "device_id": calibration.get("device_id"),
+        "calibration_v": calibration.get("v"),
+    }
+    row.update(dict.fromkeys(REGIONS))
+    # 舊紀錄可能有不在 REGIONS 的區域名稱（例如「心」），不成欄位
+    row.update((region, diagnosis) for region, diagnosis in region_pairs(doc) if region in _REGION_SET)
+    return row
+
+
+def ndjson_chunks(docs: Iterable[Dict[str, Any]], batch_size: int = BATCH_SIZE) -> Iterator[bytes]:
+    for batch in _batches(docs, batch_size):
+        lines = []
+        for doc in batch:
+            doc = _jsonable(doc)
+            doc["diagnoses"] = dict(region_pairs(doc))
+            lines.append(json.dumps(doc, ensure_ascii=False))
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def csv_chunks(docs: Iterable[Dict[str, Any]], batch_size: int = BATCH_SIZE) -> Iterator[bytes]:
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    yield ("\ufeff" + buf.getvalue()).encode("utf-8")
+    for batch in _batches(docs, batch_size):
+        buf.seek(0)
+        buf.truncate()
+        for doc in batch:
+            row = flat_row(doc)
+            if isinstance(row["timestamp"], datetime.datetime):
+                row["timestamp"] = row["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
+            writer.writerow(row)
+        yield buf.getvalue().encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands out what was written since the last drain()."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self) -> bytes:
+        out = b"".join(self._chunks)
+        self._chunks = []
+        return out
+
+
+def _parquet_schema():
+    columns = [("id", pa.string()), ("patient_id", pa.string()), ("timestamp", pa.timestamp("ms")),
+               ("image_url", pa.string()), ("main_color", pa.string()),
+               ("L", pa.float64()), ("A", pa.float64()), ("B", pa.float64())]
+    columns += [(region, pa.string()) for region in REGIONS]
+    columns += [("ruleset_v", pa.int32()), ("device_id", pa.string()), ("calibration_v", pa.int32())]
+    return pa.schema(columns)
+
+
+def parquet_chunks(docs: Iterable[Dict[str, Any]], batch_size: int = BATCH_SIZE) -> Iterator[bytes]:
+    if pq is None:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    schema = _parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for batch in _batches(docs, batch_size):
+            rows = [flat_row(doc) for doc in batch]
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()  # writes the footer
+    yield sink.drain()
+
+
+_ENCODERS = {"ndjson": ndjson_chunks, "csv": csv_chunks, "parquet": parquet_chunks}
+
+
+def _prepend(head: List[Any], rest: Iterator[Any]) -> Iterator[Any]:
+    """head then rest, closing rest (and so the cursor) when the consumer stops early."""
+    try:
+        yield from head
+        yield from rest
+    finally:
+        rest.close()
+
+
+def export_chunks(collection, fmt: str, flt: Dict[str, Any], batch_size: int = BATCH_SIZE) -> Iterator[bytes]:
+    """Byte chunks of the export; memory use is about one batch.
+
+    The query runs and the first chunk is encoded before this returns, so
+    database and encoder errors raise here rather than after a streamed
+    response has started.
+    """
+    if fmt not in available_formats():
+        raise ValueError(f"unsupported format: {fmt}")
+    docs = iter_records(collection, flt, batch_size)
+    docs = _prepend(list(itertools.islice(docs, 1)), docs)
+    chunks = _ENCODERS[fmt](docs, batch_size)
+    return _prepend(list(itertools.islice(chunks, 1)), chunks)
+
+
+if __name__ == "__main__":
+    # 匯出紀錄：python record_export.py [--patient P] [--start YYYY-MM-DD] [--end YYYY-MM-DD] [--format csv] [--out FILE]
+    import argparse, sys
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    def _date(s):
+        return datetime.datetime.strptime(s, "%Y-%m-%d")
+
+    ap = argparse.ArgumentParser(description="Stream tongueDB.records to NDJSON / CSV / Parquet")
+    ap.add_argument("--patient", help="only this patient_id")
+    ap.add_argument("--start", type=_date, help="timestamp >= (UTC date)")
+    ap.add_argument("--end", type=_date, help="timestamp < (UTC date)")
+    ap.add_argument("--format", default="ndjson", choices=list(FORMATS))
+    ap.add_argument("--out", help="output file (default stdout)")
+    ap.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = ap.parse_args()
+
+    load_dotenv()
+    records = MongoClient(os.environ["MONGO_URI"]).get_database("tongueDB").get_collection("records")
+    out = open(args.out, "wb") if args.out else sys.stdout.buffer
+    try:
+        for chunk in export_chunks(records, args.format, export_filter(args.patient, args.start, args.end),
+                                   args.batch_size):
+            out.write(chunk)
+    finally:
+        if args.out:
+            out.close()
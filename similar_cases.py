@@ -0,0 +1,232 @@
+import os, threading, time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from bson import ObjectId
+
+from color_analysis_overlay import COLOR_TO_REGION
+
+# ------------------------------------------------------------------
+# Similar-case search
+# ------------------------------------------------------------------
+# Every analysed record stores a compact colour profile in `features`:
+# LAB mean and std of the whole image and of each overlay region
+# (FEATURE_REGIONS x 6 = 30 floats).  Distances are plain Euclidean in
+# LAB units, so the mean and spread dimensions share the same scale and
+# no data-dependent normalisation has to be kept in sync.
+#
+# SimilarIndex keeps all vectors of the archive in one contiguous float32
+# matrix (grown by doubling) plus their squared norms.  A k-NN query is a
+# single matrix-vector product and np.argpartition: ~2 ms per 100k
+# records, so no tree or quantisation is needed at this scale.
+#
+# The index is loaded lazily on the first query, new uploads are added
+# in-process, and every SIMILAR_REFRESH_SECONDS the index pulls records
+# with a larger _id (uploads handled by other workers).  Deleted records
+# are tombstoned locally; deletions by other workers drop out when the
+# hits are joined back to `records`.
+#
+# Envs:
+#   SIMILAR_REFRESH_SECONDS  incremental refresh interval (default 30)
+# ------------------------------------------------------------------
+
+FEATURE_VERSION = 1
+FEATURE_REGIONS = ["整體"] + list(COLOR_TO_REGION.values())
+DIM = len(FEATURE_REGIONS) * 6
+REFRESH_SECONDS = float(os.environ.get("SIMILAR_REFRESH_SECONDS", "30"))
+
+
+def feature_vector(stats: Dict[str, Tuple[Any, Any, int]]) -> Optional[List[float]]:
+    """[L, A, B, sd_L, sd_A, sd_B] per FEATURE_REGIONS; missing regions reuse 整體."""
+    whole = stats.get("整體")
+    if whole is None:
+        return None
+    vec = []
+    for name in FEATURE_REGIONS:
+        mean, std, _ = stats.get(name) or whole
+        vec.extend(round(float(v), 2) for v in mean)
+        vec.extend(round(float(v), 2) for v in std)
+    return vec
+
+
+def _valid(vec) -> bool:
+    return isinstance(vec, (list, tuple)) and len(vec) == DIM
+
+
+class SimilarIndex:
+    def __init__(self, collection=None, refresh_seconds: float = REFRESH_SECONDS):
+        self.collection = collection
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()  # one load / refresh at a time
+        self._matrix = np.empty((0, DIM), np.float32)
+        self._norms = np.empty(0, np.float32)
+        self._alive = np.empty(0, bool)
+        self._patient_codes = np.empty(0, np.int32)
+        self._codes: Dict[str, int] = {}
+        self._ids: List[str] = []
+        self._patients: List[str] = []
+        self._pos: Dict[str, int] = {}
+        self._n = 0
+        self._last_id: Optional[ObjectId] = None
+        self._loaded = False
+        self._refreshed_at = 0.0
+
+    def __len__(self):
+        with self._lock:
+            return int(self._alive[:self._n].sum())
+
+    # ---- building ----
+
+    def _grow(self, need: int):
+        cap = self._matrix.shape[0]
+        if need <= cap:
+            return
+        cap = max(need, cap * 2, 1024)
+        for name in ("_matrix", "_norms", "_alive", "_patient_codes"):
+            old = getattr(self, name)
+            new = np.zeros((cap,) + old.shape[1:], old.dtype)
+            new[:self._n] = old[:self._n]
+            setattr(self, name, new)
+
+    def _add_locked(self, record_id: str, patient_id: str, vec):
+        if record_id in self._pos:
+            return
+        self._grow(self._n + 1)
+        row = np.asarray(vec, np.float32)
+        i = self._n
+        self._matrix[i] = row
+        self._norms[i] = float(row @ row)
+        self._alive[i] = True
+        patient_id = patient_id or ""
+        self._patient_codes[i] = self._codes.setdefault(patient_id, len(self._codes))
+        self._ids.append(record_id)
+        self._patients.append(patient_id)
+        self._pos[record_id] = i
+        self._n += 1
+
+    def add(self, record_id, patient_id: str, vec):
+        """Add one record (new upload); ignored when vec is not a feature vector."""
+        if not _valid(vec):
+            return
+        with self._lock:
+            # refresh() still pulls by _id later; duplicates are skipped there
+            self._add_locked(str(record_id), patient_id, vec)
+
+    def remove(self, record_id):
+        with self._lock:
+            i = self._pos.pop(str(record_id), None)
+            if i is not None:
+                self._alive[i] = False
+
+    def _fresh(self) -> bool:
+        return self._loaded and time.time() - self._refreshed_at < self.refresh_seconds
+
+    def refresh(self, force: bool = False) -> int:
+        """Pull records newer than the last seen _id (everything on first load).
+
+        Single flight: concurrent first queries wait for one load; once
+        loaded, a refresh already running elsewhere is not repeated.
+        """
+        if self.collection is None:
+            return 0
+        if not force and self._fresh():
+            return 0
+        if not self._refresh_lock.acquire(blocking=force or not self._loaded):
+            return 0
+        try:
+            if not force and self._fresh():
+                return 0  # loaded by the thread we waited for
+            return self._pull()
+        finally:
+            self._refresh_lock.release()
+
+    def _pull(self) -> int:
+        flt: Dict[str, Any] = {"features": {"$exists": True}}
+        if self._last_id is not None:
+            flt["_id"] = {"$gt": self._last_id}
+        cursor = self.collection.find(flt, {"_id": 1, "patient_id": 1, "features": 1}) \
+            .sort("_id", 1).batch_size(5000)
+        added = 0
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= 5000:
+                added += self._ingest(batch)
+                batch = []
+        added += self._ingest(batch)
+        self._loaded = True
+        self._refreshed_at = time.time()
+        return added
+
+    def _ingest(self, docs) -> int:
+        added = 0
+        with self._lock:
+            for doc in docs:
+                if _valid(doc.get("features")) and str(doc["_id"]) not in self._pos:
+                    self._add_locked(str(doc["_id"]), doc.get("patient_id"), doc["features"])
+                    added += 1
+                if self._last_id is None or doc["_id"] > self._last_id:
+                    self._last_id = doc["_id"]
+        return added
+
+    # ---- querying ----
+
+    def query(self, vec, k: int = 10, exclude_id: str = None,
+              patient_id: str = None, exclude_patient: str = None) -> List[Tuple[str, str, float]]:
+        """k nearest records as [(record_id, patient_id, distance)], closest first."""
+        if not _valid(vec):
+            return []
+        self.refresh()
+        q = np.asarray(vec, np.float32)
+        with self._lock:
+            n = self._n
+            if n == 0:
+                return []
+            # |x - q|^2 = |x|^2 - 2 x.q + |q|^2
+            d2 = self._norms[:n] - 2.0 * (self._matrix[:n] @ q) + float(q @ q)
+            keep = self._alive[:n].copy()
+            if exclude_id is not None and str(exclude_id) in self._pos:
+                keep[self._pos[str(exclude_id)]] = False
+            codes = self._patient_codes[:n]
+            if patient_id is not None:
+                keep &= codes == self._codes.get(patient_id, -1)
+            if exclude_patient is not None:
+                keep &= codes != self._codes.get(exclude_patient, -1)
+            ids, pats = self._ids, self._patients
+        d2 = np.where(keep, d2, np.inf)
+        k = min(k, int(keep.sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(d2, k - 1)[:k]
+        top = top[np.argsort(d2[top])]
+        return [(ids[i], pats[i], float(np.sqrt(max(0.0, d2[i])))) for i in top]
+
+
+if __name__ == "__main__":
+    # 補算舊紀錄的特徵向量（下載 image_url 重新分析）：python similar_cases.py [--limit N]
+    import sys, urllib.request
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+    from color_analysis import decode_image_bytes, fit_max_side
+    from color_analysis_overlay import analyze_tongue_regions_with_overlay_stats
+
+    load_dotenv()
+    limit = int(sys.argv[sys.argv.index("--limit") + 1]) if "--limit" in sys.argv else 0
+    max_side = int(os.environ.get("ANALYSIS_MAX_SIDE", "1280"))
+    records = MongoClient(os.environ["MONGO_URI"]).get_database("tongueDB").get_collection("records")
+    done = 0
+    for doc in records.find({"features": {"$exists": False}, "image_url": {"$exists": True}},
+                            {"image_url": 1}).limit(limit):
+        try:
+            with urllib.request.urlopen(doc["image_url"], timeout=30) as resp:
+                img = decode_image_bytes(resp.read())
+            if img is None:
+                continue
+            _, stats = analyze_tongue_regions_with_overlay_stats(fit_max_side(img, max_side))
+            records.update_one({"_id": doc["_id"]},
+                               {"$set": {"features": feature_vector(stats), "features_v": FEATURE_VERSION}})
+            done += 1
+        except Exception as e:
+            print(f"⚠️ {doc['_id']}: {e}")
+    print(f"補算 {done} 筆")
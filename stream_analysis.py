@@ -0,0 +1,302 @@
+import math, os, threading, time, uuid
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from analysis_budget import decode_within_budget, image_size, overlay_labels
+from color_analysis import fit_max_side
+from color_analysis_overlay import diagnose_region
+import quality_gate
+
+# ------------------------------------------------------------------
+# Live per-region readings from a camera stream
+# ------------------------------------------------------------------
+# The capture page posts small JPEG frames (STREAM_MAX_SIDE px) one at a
+# time and gets the smoothed per-region readings back, so the user sees
+# results before taking the real photo.
+#
+# Each frame costs one LAB conversion plus cv2.mean over per-region masks
+# cut from the overlay once per frame size (nearest-neighbour), about
+# 0.3 ms at 192 px plus the JPEG decode, so many streams fit on one core.
+# Per-region LAB means are smoothed with a time-based EMA
+# (STREAM_SMOOTHING_SECONDS), so irregular frame intervals do not change
+# the response speed.
+#
+# Frames failing the quality gate (quality_gate.assess) are reported back
+# with their reasons but do not move the readings.
+#
+# Frames are never queued.  When the stream's previous frame is still
+# being analysed, or all STREAM_WORKERS analysis slots are busy, the
+# frame is skipped and the last readings are returned.  The suggested
+# client interval (next_ms) then backs off, and shrinks again once frames
+# get through, so a loaded server sheds frames instead of falling behind.
+# Both checks run before the frame is decoded, so a skipped frame costs
+# nothing but the request.  Frames whose header declares more than
+# STREAM_MAX_FRAME_SIDE px (or no readable size) are rejected unread; JPEG
+# frames above STREAM_MAX_SIDE are decoded at a reduced libjpeg scale.
+#
+# replay() feeds a recorded sequence (directory of frames or a video
+# file) through the same session logic:
+#   python stream_analysis.py <frames_dir | video> [--fps 10]
+#
+# Envs:
+#   STREAM_MAX_SIDE            analysed frame size (default 192)
+#   STREAM_MAX_FRAME_KB        larger frame bodies are rejected (default 256)
+#   STREAM_MAX_FRAME_SIDE      larger frame dimensions are rejected (default 4 x MAX_SIDE)
+#   STREAM_WORKERS             concurrent frame analyses (default CPU count)
+#   STREAM_SMOOTHING_SECONDS   EMA time constant (default 0.5)
+#   STREAM_MIN_INTERVAL_MS / STREAM_MAX_INTERVAL_MS  next_ms bounds (100 / 2000)
+#   STREAM_IDLE_SECONDS        idle sessions are dropped after this (default 60)
+#   STREAM_MAX_SESSIONS        live sessions per process; /stream/start answers
+#                              503 beyond it (default 200)
+# ------------------------------------------------------------------
+
+MAX_SIDE = int(os.environ.get("STREAM_MAX_SIDE", "192"))
+MAX_FRAME_BYTES = int(os.environ.get("STREAM_MAX_FRAME_KB", "256")) * 1024
+MAX_FRAME_SIDE = int(os.environ.get("STREAM_MAX_FRAME_SIDE", str(4 * MAX_SIDE)))
+WORKERS = int(os.environ.get("STREAM_WORKERS", str(os.cpu_count() or 1)))
+SMOOTHING_SECONDS = float(os.environ.get("STREAM_SMOOTHING_SECONDS", "0.5"))
+MIN_INTERVAL_MS = int(os.environ.get("STREAM_MIN_INTERVAL_MS", "100"))
+MAX_INTERVAL_MS = int(os.environ.get("STREAM_MAX_INTERVAL_MS", "2000"))
+IDLE_SECONDS = float(os.environ.get("STREAM_IDLE_SECONDS", "60"))
+MAX_SESSIONS = int(os.environ.get("STREAM_MAX_SESSIONS", "200"))
+OVERLAY_PATH = "static/TongueOverlay.png"
+
+_slots = threading.BoundedSemaphore(max(1, WORKERS))
+
+
+class FrameRejected(ValueError):
+    """Frame header missing or declaring more than MAX_FRAME_SIDE pixels."""
+
+
+class TooManyStreams(RuntimeError):
+    """MAX_SESSIONS live sessions already exist."""
+
+_frame_mask_cache: "OrderedDict[Tuple[str, int, int], List[Tuple[str, np.ndarray, int]]]" = OrderedDict()
+_frame_mask_lock = threading.Lock()
+
+
+def _frame_masks(overlay_path: str, h: int, w: int) -> List[Tuple[str, np.ndarray, int]]:
+    """[(region, uint8 mask, pixel count)] at the frame size; a few sizes are kept."""
+    key = (overlay_path, h, w)
+    with _frame_mask_lock:
+        masks = _frame_mask_cache.get(key)
+        if masks is not None:
+            _frame_mask_cache.move_to_end(key)
+            return masks
+    labels_small, names = overlay_labels(overlay_path)
+    if labels_small is None:
+        raise FileNotFoundError("圖像或 overlay 讀取失敗")
+    labels = cv2.resize(labels_small, (w, h), interpolation=cv2.INTER_NEAREST)
+    masks = []
+    for k, name in enumerate(names, start=1):
+        mask = cv2.compare(labels, k, cv2.CMP_EQ)
+        masks.append((name, mask, cv2.countNonZero(mask)))
+    with _frame_mask_lock:
+        _frame_mask_cache[key] = masks
+        while len(_frame_mask_cache) > 8:
+            _frame_mask_cache.popitem(last=False)
+    return masks
+
+
+def analyze_frame(img: np.ndarray, overlay_path: str = OVERLAY_PATH) -> Dict[str, Any]:
+    """Raw (unsmoothed) per-region LAB means of one BGR frame."""
+    img = fit_max_side(img, MAX_SIDE)
+    h, w = img.shape[:2]
+    lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+    regions = {name: np.array(cv2.mean(lab, mask=mask)[:3])
+               for name, mask, count in _frame_masks(overlay_path, h, w) if count}
+    return {"overall": np.array(cv2.mean(lab)[:3]), "regions": regions}
+
+
+def _reading(name: str, lab: np.ndarray) -> Dict[str, Any]:
+    L, A, B = (float(v) for v in lab)
+    return {"區域": name, "L": round(L, 1), "A": round(A, 1), "B": round(B, 1),
+            "診斷": diagnose_region(L, A, B)}
+
+
+class StreamSession:
+    """Smoothed readings and pacing state of one camera stream."""
+
+    def __init__(self, stream_id: str = None, smoothing: float = SMOOTHING_SECONDS,
+                 lut: Optional[np.ndarray] = None):
+        self.stream_id = stream_id or uuid.uuid4().hex
+        self.smoothing = smoothing
+        self.lut = lut  # device calibration table (color_calibration.build_lut)
+        self.interval_ms = MIN_INTERVAL_MS
+        self.frames = 0
+        self.skipped = 0
+        self.last_seen = time.time()
+        self._ema: Dict[str, np.ndarray] = {}
+        self._last_t: Optional[float] = None
+        self._proc_ms = 0.0
+        self._busy = threading.Lock()      # one frame analysed at a time
+        self._ema_lock = threading.Lock()  # readings() runs on the skip path without _busy
+
+    def _smooth(self, raw: Dict[str, Any], t: float):
+        if self._last_t is None or self.smoothing <= 0:
+            alpha = 1.0
+        else:
+            alpha = 1.0 - math.exp(-max(0.0, t - self._last_t) / self.smoothing)
+        self._last_t = t
+        items = dict(raw["regions"], **{"整體": raw["overall"]})
+        with self._ema_lock:
+            for name, lab in items.items():
+                prev = self._ema.get(name)
+                self._ema[name] = lab if prev is None else prev + alpha * (lab - prev)
+
+    def readings(self) -> Dict[str, Any]:
+        with self._ema_lock:
+            ema = dict(self._ema)
+        overall = ema.get("整體")
+        return {
+            "stream_id": self.stream_id,
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "next_ms": int(self.interval_ms),
+            "overall": _reading("整體", overall) if overall is not None else None,
+            "regions": [_reading(name, lab) for name, lab in ema.items() if name != "整體"],
+        }
+
+    def _back_off(self):
+        self.skipped += 1
+        self.interval_ms = min(MAX_INTERVAL_MS, self.interval_ms * 1.5)
+
+    def feed(self, img: np.ndarray, t: float = None, overlay_path: str = OVERLAY_PATH) -> Dict[str, Any]:
+        """Analyse one frame unless this stream or the server is busy (then skip)."""
+        return self._feed(lambda: img, t, overlay_path)
+
+    def feed_bytes(self, data: bytes, t: float = None) -> Optional[Dict[str, Any]]:
+        """feed() for an encoded frame; decoded only once a slot is held.
+
+        Returns None when the frame cannot be decoded; raises FrameRejected
+        for oversized or unreadable headers.
+        """
+        size = image_size(data)
+        if size is None:
+            raise FrameRejected("unreadable frame header")
+        if max(size) > MAX_FRAME_SIDE:
+            raise FrameRejected(f"frame {size[0]}x{size[1]} exceeds {MAX_FRAME_SIDE}px")
+        return self._feed(lambda: decode_within_budget(data, MAX_SIDE, budget_bytes=0)[0], t)
+
+    def _feed(self, load, t: float = None, overlay_path: str = OVERLAY_PATH) -> Optional[Dict[str, Any]]:
+        t = time.time() if t is None else t
+        self.last_seen = time.time()
+        if not self._busy.acquire(blocking=False):
+            self._back_off()
+            return dict(self.readings(), skipped_frame=True)
+        try:
+            if not _slots.acquire(blocking=False):
+                self._back_off()
+                return dict(self.readings(), skipped_frame=True)
+            try:
+                t0 = time.perf_counter()
+                img = load()
+                if img is None:
+                    return None
+                quality = quality_gate.assess(img)
+                raw = None
+                if quality["ok"] or not quality_gate.ENABLED:
+                    if self.lut is not None:
+                        img = cv2.LUT(img, self.lut)
+                    raw = analyze_frame(img, overlay_path)
+                self._proc_ms = (time.perf_counter() - t0) * 1000.0
+            finally:
+                _slots.release()
+            # unusable frames (blurred, dark, no tongue) do not move the readings
+            if raw is not None:
+                self._smooth(raw, t)
+                self.frames += 1
+            # back towards the fastest rate, but never below twice the analysis time
+            self.interval_ms = max(MIN_INTERVAL_MS, self._proc_ms * 2, self.interval_ms * 0.8)
+            return dict(self.readings(), skipped_frame=False, quality=quality)
+        finally:
+            self._busy.release()
+
+
+class StreamRegistry:
+    """Live sessions by id (at most max_sessions); idle ones are dropped lazily."""
+
+    def __init__(self, idle_seconds: float = IDLE_SECONDS, max_sessions: int = MAX_SESSIONS):
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self._sessions: Dict[str, StreamSession] = {}
+        self._lock = threading.Lock()
+
+    def start(self, lut: Optional[np.ndarray] = None) -> StreamSession:
+        """New session; raises TooManyStreams when max_sessions are live."""
+        self._sweep()
+        s = StreamSession(lut=lut)
+        with self._lock:
+            if len(self._sessions) >= self.max_sessions:
+                raise TooManyStreams(f"{len(self._sessions)} live streams")
+            self._sessions[s.stream_id] = s
+        return s
+
+    def get(self, stream_id: str) -> Optional[StreamSession]:
+        with self._lock:
+            return self._sessions.get(stream_id)
+
+    def stop(self, stream_id: str) -> Optional[StreamSession]:
+        with self._lock:
+            return self._sessions.pop(stream_id, None)
+
+    def active(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def _sweep(self):
+        cutoff = time.time() - self.idle_seconds
+        with self._lock:
+            for sid in [sid for sid, s in self._sessions.items() if s.last_seen < cutoff]:
+                del self._sessions[sid]
+
+
+registry = StreamRegistry()
+
+
+# ---- recorded sequences ----
+
+def read_frames(source: str, fps: float = 10.0) -> Iterator[Tuple[float, np.ndarray]]:
+    """(timestamp, BGR frame) from a directory of images (sorted by name) or a video file."""
+    if os.path.isdir(source):
+        names = sorted(n for n in os.listdir(source)
+                       if n.lower().rsplit(".", 1)[-1] in ("jpg", "jpeg", "png", "webp", "bmp"))
+        for i, name in enumerate(names):
+            img = cv2.imread(os.path.join(source, name))
+            if img is not None:
+                yield i / fps, img
+        return
+    cap = cv2.VideoCapture(source)
+    try:
+        src_fps = cap.get(cv2.CAP_PROP_FPS) or fps
+        i = 0
+        while True:
+            ok, img = cap.read()
+            if not ok:
+                break
+            yield i / src_fps, img
+            i += 1
+    finally:
+        cap.release()
+
+
+def replay(frames: Iterable[Tuple[float, np.ndarray]],
+           session: StreamSession = None) -> Iterator[Dict[str, Any]]:
+    """Feed recorded (timestamp, frame) pairs through a session; yield each response."""
+    session = session or StreamSession()
+    for t, img in frames:
+        yield dict(session.feed(img, t), t=round(t, 3))
+
+
+if __name__ == "__main__":
+    import argparse, json
+
+    ap = argparse.ArgumentParser(description="Replay a recorded frame sequence through the live analyzer")
+    ap.add_argument("source", help="directory of frames or a video file")
+    ap.add_argument("--fps", type=float, default=10.0, help="timestamps for a frame directory")
+    args = ap.parse_args()
+    for out in replay(read_frames(args.source, args.fps)):
+        print(json.dumps(out, ensure_ascii=False))